@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+DESCRIPTION = \
+"""
+Micro-benchmarks for the hot paths of the batch-import scripts. Each sub-command times the current
+implementation against the older one it replaced and prints the results.
+"""
+
+EXAMPLES = \
+"""
+Example:
+
+    Compare the file-hashing methods of camio_hooks.py on a 512 MB file:
+
+    python benchmarks.py hash --size_mb 512
+
+    or on an existing video file:
+
+    python benchmarks.py hash --file /videos/camera1-1494270000.mp4
+
+    Compare looking up the rows of each shard by scanning the importer db against the shard index,
+    for 20000 files split over 5, 10, 20 and 40 shards:
+
+    python benchmarks.py shards --items 20000 --shards 5 10 20 40
+
+    Compare parsing 100000 label timestamps with dateutil against the fast path of download_labels.py:
+
+    python benchmarks.py timestamps --count 100000
+"""
+
+import os
+import sys
+import time
+import argparse
+import logging
+import tempfile
+import shelve
+import shutil
+import textwrap
+import random
+import dateutil.parser
+
+import camio_hooks
+import download_labels
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+def timed(func, *args, **kwargs):
+    """ returns (seconds, result) of calling func(*args, **kwargs) """
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+def report(name, seconds, amount, unit):
+    logging.info("%-24s %8.3f s  %12.1f %s/s", name, seconds, amount / seconds if seconds else 0, unit)
+
+def benchmark_hash(args):
+    filepath = args.file
+    if not filepath:
+        fd, filepath = tempfile.mkstemp(suffix='.bin')
+        with os.fdopen(fd, 'wb') as fh:
+            chunk = os.urandom(1 << 20)
+            for _ in range(args.size_mb):
+                fh.write(chunk)
+    size_mb = os.path.getsize(filepath) / 1e6
+    methods = [
+        ('read (64 KiB)', camio_hooks.hash_file_in_chunks),
+        ('readinto (1 MiB)', camio_hooks.hash_file_readinto),
+        ('mmap', camio_hooks.hash_file_mmap),
+    ]
+    logging.info("hashing %s (%.1f MB), best of %d runs", filepath, size_mb, args.repeat)
+    try:
+        digests = set()
+        for name, func in methods:
+            best = None
+            for _ in range(args.repeat):
+                with open(filepath, 'rb') as fh:
+                    seconds, digest = timed(func, fh)
+                best = seconds if best is None else min(best, seconds)
+            digests.add(digest)
+            report(name, best, size_mb, 'MB')
+        if len(digests) != 1:
+            logging.error("hashing methods disagree: %r", digests)
+    finally:
+        if not args.file:
+            os.remove(filepath)
+
+def scan_shard_rows(db, job_id, shard_id):
+    """ how register_jobs used to find the rows of a shard: a filter over every value in the db """
+    return filter(lambda params: (params['job_id'], params['shard_id']) == (job_id, shard_id), db.values())
+
+def indexed_shard_rows(db, job_id, shard_id):
+    return [db[key] for key in camio_hooks.get_shard_index()[(job_id, shard_id)]]
+
+def benchmark_shards(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for shard_count in args.shards:
+            db = shelve.open(os.path.join(tmpdir, 'db_%d' % shard_count))
+            for k in range(args.items):
+                key = '%040x' % k
+                db[key] = dict(key=key, job_id='job', shard_id=str(k % shard_count),
+                        filename='video_%d.mp4' % k, size=1e6)
+            db.sync()
+            jobs = [('job', str(shard_id)) for shard_id in range(shard_count)]
+            camio_hooks.CAMIO_PARAMS['shard_index_file'] = os.path.join(tmpdir, 'index_%d.json' % shard_count)
+            camio_hooks.SHARD_INDEX = None
+            logging.info("%d items over %d shards", args.items, shard_count)
+            seconds, _ = timed(lambda: [scan_shard_rows(db, *job) for job in jobs])
+            report('scan per shard', seconds, shard_count, 'shards')
+            seconds, _ = timed(lambda: (camio_hooks.build_shard_index(db, jobs),
+                    [indexed_shard_rows(db, *job) for job in jobs]))
+            report('index (cold)', seconds, shard_count, 'shards')
+            seconds, _ = timed(lambda: [indexed_shard_rows(db, *job) for job in jobs])
+            report('index (warm)', seconds, shard_count, 'shards')
+            db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+TIMESTAMP_FORMATS = ['%Y-%m-%dT%H:%M:%S.{ms}-0000', '%Y-%m-%dT%H:%M:%S.{ms}+00:00', '%Y-%m-%dT%H:%M:%SZ']
+
+def dateutil_microseconds(date):
+    """ how download_labels used to get the time of a label: a dateutil parse per call """
+    delta = download_labels.as_utc(dateutil.parser.parse(date)) - download_labels.EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def benchmark_timestamps(args):
+    start = download_labels.parse_timestamp('2017-05-01T00:00:00.000-0000')
+    timestamps = []
+    for _ in range(args.count):
+        date = start + download_labels.timedelta(milliseconds=random.randint(0, 30 * 86400 * 1000))
+        timestamps.append(date.strftime(random.choice(TIMESTAMP_FORMATS).format(ms='%03d' % (date.microsecond // 1000))))
+    logging.info("parsing %d timestamps in %d formats", len(timestamps), len(TIMESTAMP_FORMATS))
+    seconds, slow = timed(lambda: [dateutil_microseconds(date) for date in timestamps])
+    report('dateutil', seconds, len(timestamps), 'timestamps')
+    seconds, fast = timed(lambda: [download_labels.epoch_microseconds(date) for date in timestamps])
+    report('fast path', seconds, len(timestamps), 'timestamps')
+    seconds, _ = timed(lambda: [download_labels.canonical_timestamp(date) for date in timestamps])
+    report('canonical keys', seconds, len(timestamps), 'timestamps')
+    if slow != fast:
+        logging.error("parsing methods disagree on %d timestamps", sum(a != b for (a, b) in zip(slow, fast)))
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent(DESCRIPTION), epilog=EXAMPLES
+    )
+    subparsers = parser.add_subparsers()
+    hash_parser = subparsers.add_parser('hash', help='compare the file-hashing methods used before uploading a video')
+    hash_parser.add_argument('-f', '--file', type=str, default=None, help='the file to hash (default = a temporary random file)')
+    hash_parser.add_argument('-s', '--size_mb', type=int, default=256, help='size of the temporary file in MB (default = 256)')
+    hash_parser.add_argument('-r', '--repeat', type=int, default=3, help='number of runs per method, the best is reported (default = 3)')
+    hash_parser.set_defaults(func=benchmark_hash)
+    shards_parser = subparsers.add_parser('shards', help='compare finding the files of each job shard by db scan and by shard index')
+    shards_parser.add_argument('-i', '--items', type=int, default=20000, help='number of files in the db (default = 20000)')
+    shards_parser.add_argument('-s', '--shards', type=int, nargs='+', default=[5, 10, 20, 40], help='shard counts to try (default = 5 10 20 40)')
+    shards_parser.set_defaults(func=benchmark_shards)
+    timestamps_parser = subparsers.add_parser('timestamps', help='compare parsing label timestamps with dateutil and with the fast path of download_labels')
+    timestamps_parser.add_argument('-c', '--count', type=int, default=100000, help='number of timestamps to parse (default = 100000)')
+    timestamps_parser.set_defaults(func=benchmark_timestamps)
+    camio_hooks.set_hook_data({'logger': logging.getLogger()})
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
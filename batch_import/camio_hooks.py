@@ -10,7 +10,13 @@ import json
 import logging
 import logging
 import hashlib
+import bisect
+import cPickle
+import mmap
+import shelve
 import datetime
+import threading
+import Queue
 import requests
 
 """
@@ -40,22 +46,133 @@ Log = None
 # plan definitions for actual_values entry
 CAMIO_PLANS = { 'pro': 'PRO', 'plus': 'PLUS', 'basic': 'BASIC' }
 
+# connection-pool sizes and timeouts for the keep-alive sessions. These can be overridden through the
+# hook-data json with the keys 'api_pool_size', 'box_pool_size', 'api_timeout' and 'box_timeout'.
+# timeouts are either a number of seconds or a [connect, read] pair
+API_POOL_SIZE = 4
+BOX_POOL_SIZE = 4
+API_TIMEOUT_SECONDS = (10, 60)
+BOX_TIMEOUT_SECONDS = (10, 600)
+# number of times an API request that timed out is sent again before network_request gives up ('api_timeout_retries')
+API_TIMEOUT_RETRIES = 2
+
+# handles to the pooled sessions, keyed by 'api' (camio.com) and 'box' (the Box /box/content endpoint)
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+
+# how long (in seconds) the device list and Box state fetched from camio.com are reused
+# before being fetched again. Override with the 'discovery_cache_ttl' hook-data key, and set 'discovery_cache_file'
+# to a path to keep these across runs of the importer
+DISCOVERY_CACHE_TTL_SECONDS = 600
+
+# delays (in seconds) between polls of the discovered-camera map while waiting for newly registered cameras
+REGISTER_POLL_SECONDS = (1, 2, 4, 8, 16, 32)
+
+# number of uploads kept in flight to the Box by post_video_contents, can be overridden
+# through the hook-data json with the key 'upload_concurrency'
+UPLOAD_CONCURRENCY = 4
+
+# persistent cache of file hashes, keyed by (path, size, mtime, inode) so that retries and re-runs
+# don't re-read unchanged videos. The location can be overridden with the 'hash_cache_file' hook-data
+# key, setting it to an empty string disables the on-disk cache
+HASH_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.camio_hash_cache')
+HASH_CHUNK_SIZE = 1 << 20
+HASH_CACHE = {}
+HASH_CACHE_LOCK = threading.Lock()
+HASH_BUFFERS = threading.local()
+
+# index of the db keys belonging to each (job_id, shard_id), written by assign_job_ids and read by register_jobs
+# so that a shard's rows can be loaded without unpickling the whole importer db. Set the 'shard_index_file'
+# hook-data key to keep it next to the importer db
+SHARD_INDEX_FILE = '.camio_shard_index.json'
+SHARD_INDEX = None
+
+# assign_job_ids writes the shard assignments to the importer db in batches of this many items ('assign_batch_size'
+# in the hook data). Each batch is first written to the journal file ('assign_journal_file') so that a batch
+# interrupted by a crash is replayed into the db on the next run
+ASSIGN_BATCH_SIZE = 500
+ASSIGN_JOURNAL_FILE = '.camio_assign_journal'
+
+# back-off bounds (in seconds) when the Box answers with a 429 rate-limit response
+RATE_LIMIT_BASE_SECONDS = 30
+RATE_LIMIT_MAX_SECONDS = 240
+
 def fail(msg, *args):
     Log.error(msg, *args)
     sys.exit(1)
 
+def get_session_timeout(kind):
+    """ returns the requests-style timeout for the 'api' or 'box' session """
+    default = API_TIMEOUT_SECONDS if kind == 'api' else BOX_TIMEOUT_SECONDS
+    timeout = CAMIO_PARAMS.get('%s_timeout' % kind, default)
+    if isinstance(timeout, list):
+        timeout = tuple(timeout)
+    return timeout
+
+def get_session(kind):
+    """
+    returns the keep-alive requests.Session used for the given kind of endpoint, creating it on first use.
+    kind: 'api' for calls to the Camio servers, 'box' for video uploads to the Box /box/content endpoint.
+    The two are kept apart so that long-running uploads to the Box never starve the API calls of connections.
+    """
+    session = SESSIONS.get(kind)
+    if session is not None:
+        return session
+    # the upload threads all ask for the 'box' session on their first upload, only one of them may create it
+    with SESSIONS_LOCK:
+        session = SESSIONS.get(kind)
+        if session is None:
+            default = API_POOL_SIZE if kind == 'api' else BOX_POOL_SIZE
+            pool_size = int(CAMIO_PARAMS.get('%s_pool_size' % kind, default))
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            SESSIONS[kind] = session
+            Log.debug("created %s session with pool size: %d", kind, pool_size)
+    return session
+
+def get_connection_stats():
+    """
+    returns the per-host connection-reuse counters of the pooled sessions as
+    { "host:port": {"requests": n, "connections": c, "reused": n - c}, ... }
+    """
+    stats = {}
+    for kind, session in SESSIONS.items():
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                host = "%s:%s" % (pool.host, pool.port)
+                entry = stats.setdefault(host, {'requests': 0, 'connections': 0, 'reused': 0})
+                entry['requests'] += pool.num_requests
+                entry['connections'] += pool.num_connections
+                entry['reused'] = max(entry['requests'] - entry['connections'], 0)
+    return stats
+
+def log_connection_stats():
+    for host, entry in sorted(get_connection_stats().items()):
+        Log.info("connections to %s: %d requests over %d connections (%d reused)",
+                host, entry['requests'], entry['connections'], entry['reused'])
+
 def network_request(reqtype, url, data=None, json=None):
     access_token = get_access_token()
     headers = {"Authorization": "token %s" % access_token}
-    func = getattr(requests, reqtype)
+    func = getattr(get_session('api'), reqtype)
     ret = None
     Log.debug("making %s request to URL (%s)", reqtype, url)
-    try:
-        ret = func(url, headers=headers, data=data, json=json)
-        Log.debug("return from call: %r", ret)
-    except Exception, e:
-        Log.error("%s request to url (%s) failed")
-        Log.error(traceback.format_exc())
+    retries = int(CAMIO_PARAMS.get('api_timeout_retries', API_TIMEOUT_RETRIES))
+    for attempt in range(retries + 1):
+        try:
+            ret = func(url, headers=headers, data=data, json=json, timeout=get_session_timeout('api'))
+            Log.debug("return from call: %r", ret)
+            break
+        except requests.exceptions.Timeout, e:
+            Log.error("%s request to url (%s) timed out, %d more retries left", reqtype, url, retries - attempt)
+        except Exception, e:
+            Log.error("%s request to url (%s) failed", reqtype, url)
+            Log.error(traceback.format_exc())
+            break
     return ret
 
 def set_hook_data(data_dict):
@@ -79,6 +196,71 @@ def set_hook_data(data_dict):
         CAMIO_SERVER_URL = CAMIO_TEST_SERVER_URL
     Log.debug("setting camio_hooks data as:\n%s", pprint.pformat(CAMIO_PARAMS, indent=2))
 
+class TTLCache(object):
+    """
+    a small thread-safe key-value cache whose entries expire $ttl seconds after they were set.
+    If $filename is given the entries are also written to that file as json so they survive restarts.
+    """
+    def __init__(self, ttl, filename=None):
+        self.ttl = ttl
+        self.filename = filename
+        self.entries = {}
+        self.lock = threading.Lock()
+        if filename and os.path.exists(filename):
+            try:
+                with open(filename) as fh:
+                    self.entries = json.load(fh)
+            except Exception, e:
+                Log.warn("unable to read discovery cache from %s, starting empty", filename)
+                Log.debug(traceback.format_exc())
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                del self.entries[key]
+                return None
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.save()
+
+    def invalidate(self, key):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                Log.debug("invalidated cached entry: %s", key)
+                self.save()
+
+    def save(self):
+        """ write the entries to disk, the caller must hold the lock """
+        if not self.filename:
+            return
+        try:
+            with open(self.filename, 'w') as fh:
+                json.dump(self.entries, fh)
+        except Exception, e:
+            Log.warn("unable to write discovery cache to %s", self.filename)
+            Log.debug(traceback.format_exc())
+
+# created by get_discovery_cache() once the hook data is known
+DISCOVERY_CACHE = None
+
+def get_discovery_cache():
+    global DISCOVERY_CACHE
+    if DISCOVERY_CACHE is None:
+        DISCOVERY_CACHE = TTLCache(float(CAMIO_PARAMS.get('discovery_cache_ttl', DISCOVERY_CACHE_TTL_SECONDS)),
+                CAMIO_PARAMS.get('discovery_cache_file'))
+    return DISCOVERY_CACHE
+
+def invalidate_box_state(device_id):
+    """ forget the cached state (and so the IP address) of the Box, e.g. after failing to connect to it """
+    get_discovery_cache().invalidate('box_state:%s' % device_id)
+
 def get_account_info():
     """
     this function takes an auth token and gathers both the device ID of their
@@ -88,12 +270,16 @@ def get_account_info():
     access_token = get_access_token()
     device_id = get_device_id(fail=False)
     ip_address = CAMIO_PARAMS.get('ip_address')
+    cache = get_discovery_cache()
     if not device_id:
-        url = CAMIO_SERVER_URL + CAMIO_DEVICES_ENDPOINT
-        ret = network_request('get', url)
-        if not ret:
-            fail("unable to obtain account info (device_id and Box IP address")
-        devices = ret.json()
+        devices = cache.get('devices')
+        if devices is None:
+            url = CAMIO_SERVER_URL + CAMIO_DEVICES_ENDPOINT
+            ret = network_request('get', url)
+            if not ret:
+                fail("unable to obtain account info (device_id and Box IP address")
+            devices = ret.json()
+            cache.set('devices', devices)
         if not devices or len(devices) < 1:
             fail('no Camio Box devices found on your account, have you registered your Box yet?')
         elif len(devices) == 1:
@@ -117,16 +303,22 @@ def get_account_info():
             device_id = devices[selection-1]['device_id']
         CAMIO_PARAMS['device_id'] = device_id
     if not ip_address:
-        url = CAMIO_SERVER_URL + CAMIO_STATE_ENDPOINT + "?device_id=%s" % device_id
-        ret = network_request('get', url)
-        device = ret.json()
-        network_config = device.get('state').get('network_configuration_actual')
-        if not network_config:
-            fail("unable to obtain IP address of Camio box. If you just started the machine wait a minute before trying again")
+        # the discovered IP address is only cached (not stored in CAMIO_PARAMS) so that a Box
+        # that changed address is picked up again once its cached state is invalidated
+        network_config = cache.get('box_state:%s' % device_id)
+        if network_config is None:
+            url = CAMIO_SERVER_URL + CAMIO_STATE_ENDPOINT + "?device_id=%s" % device_id
+            ret = network_request('get', url)
+            if not ret:
+                fail("unable to obtain IP address of Camio box")
+            device = ret.json()
+            network_config = device.get('state').get('network_configuration_actual')
+            if not network_config:
+                fail("unable to obtain IP address of Camio box. If you just started the machine wait a minute before trying again")
+            cache.set('box_state:%s' % device_id, network_config)
         ip_address = network_config.get('ip_address')
-        if not network_config:
+        if not ip_address:
             fail("unable to obtain IP address of Camio box")
-        CAMIO_PARAMS['ip_address'] = ip_address
     return ip_address, device_id
 
 
@@ -141,6 +333,70 @@ def hash_file_in_chunks(fh, chunksize=65536):
         sha1.update(data)
     return sha1.hexdigest()
 
+def hash_file_readinto(fh, chunksize=HASH_CHUNK_SIZE):
+    """ same as hash_file_in_chunks, but reads into a buffer that is reused across calls (one per thread)
+    instead of allocating a new string for every chunk """
+    buf = getattr(HASH_BUFFERS, 'buf', None)
+    if buf is None or len(buf) != chunksize:
+        buf = HASH_BUFFERS.buf = bytearray(chunksize)
+    view = memoryview(buf)
+    sha1 = hashlib.sha1()
+    while True:
+        size = fh.readinto(buf)
+        if not size:
+            break
+        sha1.update(view[:size])
+    return sha1.hexdigest()
+
+def hash_file_mmap(fh):
+    """ get the SHA1 of the file by memory-mapping it, falls back to hash_file_readinto when the
+    file cannot be mapped (empty files, or files larger than the address space) """
+    try:
+        mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError, OverflowError):
+        return hash_file_readinto(fh)
+    try:
+        return hashlib.sha1(mapped).hexdigest()
+    finally:
+        mapped.close()
+
+def get_hash_cache():
+    """ opens the on-disk hash cache on first use, returns a plain dict when it is disabled or unavailable """
+    global HASH_CACHE
+    filename = CAMIO_PARAMS.get('hash_cache_file', HASH_CACHE_FILE)
+    if filename and not isinstance(HASH_CACHE, shelve.Shelf):
+        try:
+            HASH_CACHE = shelve.open(filename)
+            Log.debug("using file-hash cache: %s", filename)
+        except Exception, e:
+            Log.warn("unable to open file-hash cache %s, hashes will only be cached in memory", filename)
+            Log.debug(traceback.format_exc())
+            CAMIO_PARAMS['hash_cache_file'] = None
+    return HASH_CACHE
+
+def get_file_hash(filepath):
+    """
+    returns the SHA1 of the file at $filepath, reading the file only if it isn't in the hash cache yet.
+    The cache key includes the size, mtime and inode of the file so a modified or replaced file is re-hashed.
+    """
+    info = os.stat(filepath)
+    key = "%s|%d|%r|%d" % (os.path.abspath(filepath), info.st_size, info.st_mtime, info.st_ino)
+    if isinstance(key, unicode):
+        key = key.encode('utf8')
+    with HASH_CACHE_LOCK:
+        filehash = get_hash_cache().get(key)
+    if filehash:
+        Log.debug("using cached hash for file: %s", filepath)
+        return filehash
+    with open(filepath, 'rb') as fh:
+        filehash = hash_file_readinto(fh)
+    with HASH_CACHE_LOCK:
+        cache = get_hash_cache()
+        cache[key] = filehash
+        if isinstance(cache, shelve.Shelf):
+            cache.sync()
+    return filehash
+
 def get_access_token():
     if not CAMIO_PARAMS.get('access_token'):
         token = os.environ.get(CAMIO_OAUTH_TOKEN_ENVVAR)
@@ -150,11 +406,71 @@ def get_access_token():
         CAMIO_PARAMS['access_token'] = token
     return CAMIO_PARAMS['access_token']
 
-def dateshift(timestamp, seconds, format = "%Y-%m-%dT%H:%M:%S.%f"):
-    date = datetime.datetime.strptime(timestamp[:23], format)
+ISO_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+def parse_timestamp(timestamp, format = ISO_TIMESTAMP_FORMAT):
+    """ parses the first 23 characters of $timestamp with $format. Timestamps like 2017-05-05T01:31:13.738
+    are sliced directly, which is much faster than strptime; anything else falls back to strptime """
+    if format == ISO_TIMESTAMP_FORMAT and len(timestamp) >= 23 and timestamp[19] == '.' \
+            and timestamp[4] == timestamp[7] == '-' and timestamp[10] == 'T' and timestamp[13] == timestamp[16] == ':':
+        try:
+            return datetime.datetime(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                    int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]), int(timestamp[20:23]) * 1000)
+        except ValueError:
+            pass
+    return datetime.datetime.strptime(timestamp[:23], format)
+
+def dateshift(timestamp, seconds, format = ISO_TIMESTAMP_FORMAT):
+    date = parse_timestamp(timestamp, format)
     date = date + datetime.timedelta(seconds=seconds)
     return date.strftime(format)
 
+# length of json.dumps({'key': '', 'original_filename': '', 'size_MB': ...}) without the values
+JOB_ITEM_JSON_OVERHEAD = len(json.dumps({'key': '', 'original_filename': '', 'size_MB': 0})) - 1
+
+def json_length(text):
+    """ the length of $text once escaped as a json string, without the quotes """
+    return len(json.dumps(text)) - 2
+
+class JobSummary(object):
+    """
+    the statistics sent when registering a job (item count, earliest and latest dates and average item size),
+    aggregated in a single pass. Items can be added one at a time with add() or from any iterable with extend(),
+    so the caller doesn't need to hold every item in a list.
+    """
+    def __init__(self, items=None):
+        self.item_count = 0
+        self.earliest_date = None
+        self.latest_datetime = None
+        self.total_size_bytes = 0
+        if items is not None:
+            self.extend(items)
+
+    def add(self, params):
+        self.item_count += 1
+        timestamp = params['timestamp']
+        if self.earliest_date is None or timestamp < self.earliest_date:
+            self.earliest_date = timestamp
+        end = parse_timestamp(timestamp) + datetime.timedelta(seconds=params['duration'])
+        if self.latest_datetime is None or end > self.latest_datetime:
+            self.latest_datetime = end
+        # the size of the json description of the item, only escaping its strings instead of serializing all of it
+        self.total_size_bytes += JOB_ITEM_JSON_OVERHEAD + json_length(params['key']) + json_length(params['filename']) \
+                + len(repr(params['size']/1e6))
+
+    def extend(self, items):
+        for params in items:
+            self.add(params)
+        return self
+
+    @property
+    def latest_date(self):
+        return self.latest_datetime.strftime(ISO_TIMESTAMP_FORMAT) if self.latest_datetime else None
+
+    @property
+    def item_average_size_bytes(self):
+        return self.total_size_bytes // self.item_count if self.item_count else 0
+
 def get_device_id(fail=True):
     """ if fail we exit if the ID cannot be located """
     device = None
@@ -209,15 +525,6 @@ def get_camera_image_resolutions(camera_name):
         actual_values[item] = dict(options=[{'name': item, 'value': value}])
     return actual_values
 
-def get_camera_config(local_camera_id):
-    access_token = get_access_token()
-    headers = {"Authorization": "token %s" % access_token}
-    url = CAMIO_SERVER_URL + CAMIO_REGISTER_ENDPOINT
-    response = network_request('get', url)
-    response = response.json()
-    Log.debug("cameras under account:\n%r", [response[camera].get('name') for camera in response])
-    return response[local_camera_id]
-
 def generate_actual_values(camera_name):
     camera_plan = get_camera_plan(camera_name)
     image_values = get_camera_image_resolutions(camera_name)
@@ -252,12 +559,14 @@ def register_camera(camera_name, port=None, host=None):
                  Note that the host and port are not used by Camio. This is because we don't register
                  cameras with the segmenter
     """
-    ip_address, device_id = get_account_info()
-    access_token = get_access_token()
+    return register_cameras([camera_name])[camera_name]
+
+def generate_camera_payload(camera_name, device_id):
+    """ returns the /api/cameras/discovered entry describing the batch-import camera $camera_name """
     user_agent = "video-importer script"
     local_camera_id = hashlib.sha1(camera_name).hexdigest()
     actual_values = generate_actual_values(camera_name)
-    payload = dict(
+    return dict(
             device_id_discovering=device_id,
             acquisition_method='batch',
             device_user_agent=user_agent,
@@ -269,18 +578,123 @@ def register_camera(camera_name, port=None, host=None):
             is_authenticated=True,
             should_config=True # toggles the camera 'ON'
     )
-    Log.info("registering camera: name=%s, local_camera_id=%s", camera_name, local_camera_id)
-    payload = {local_camera_id: payload}
-    headers = {"Authorization": "token %s" % access_token}
+
+def register_cameras(camera_names):
+    """
+    arguments:
+        camera_names  - a list of camera names (as parsed from the filenames)
+    returns: a dictionary mapping each camera name to its config as described in register_camera.
+             Raises KeyError if some of the cameras did not show up in the discovered-camera map in time
+
+    description: batch counterpart of register_camera. All cameras are registered with a single POST
+                 to /api/cameras/discovered (the payload is keyed by local_camera_id), then the discovered
+                 map is polled with an increasing delay (see REGISTER_POLL_SECONDS) until every camera
+                 appears in it.
+    """
+    ip_address, device_id = get_account_info()
+    local_camera_ids = dict((camera_name, hashlib.sha1(camera_name).hexdigest()) for camera_name in camera_names)
+    payload = {}
+    for camera_name, local_camera_id in local_camera_ids.items():
+        Log.info("registering camera: name=%s, local_camera_id=%s", camera_name, local_camera_id)
+        payload[local_camera_id] = generate_camera_payload(camera_name, device_id)
     url = CAMIO_SERVER_URL + CAMIO_REGISTER_ENDPOINT
     response = network_request('post', url, json=payload)
-    try:
-        config = get_camera_config(local_camera_id)
-    except:
-        Log.info("key error for new camera, waiting 15 seconds to retry")
-        time.sleep(15)
-        config = get_camera_config(local_camera_id)
-    return config
+    if response is None or response.status_code >= 400:
+        fail("unable to register cameras: %s, return code: %r", ", ".join(camera_names),
+                response.status_code if response is not None else None)
+    discovered = {}
+    missing = list(camera_names)
+    for delay in (0,) + REGISTER_POLL_SECONDS:
+        if delay:
+            Log.info("%d new cameras not discovered yet, waiting %d seconds to retry", len(missing), delay)
+            time.sleep(delay)
+        response = network_request('get', url)
+        try:
+            if response.status_code != 200:
+                raise ValueError("return code: %d" % response.status_code)
+            discovered = response.json()
+        except Exception, e:
+            # a failed poll tells nothing about the cameras, keep what the last good one found
+            Log.error("unable to obtain the discovered cameras: %r", response)
+            continue
+        missing = [name for name, local_camera_id in local_camera_ids.items() if local_camera_id not in discovered]
+        if not missing:
+            break
+    if missing:
+        Log.error("cameras not found after registering them: %s", ", ".join(missing))
+        raise KeyError("cameras not discovered: %s" % ", ".join(missing))
+    return dict((camera_name, discovered.get(local_camera_id)) for camera_name, local_camera_id in local_camera_ids.items())
+
+class AdaptiveRateLimiter(object):
+    """
+    a back-off shared by every upload worker and driven by the 429 responses of the Box.
+    A 429 pushes back the time at which any worker may send its next upload, doubling the delay
+    each time (up to max_delay), and successful uploads halve it again. 429s for requests that
+    were sent before the current back-off was decided do not escalate it any further, so N workers
+    hitting the limit at once only back off once.
+    """
+    def __init__(self, base_delay=RATE_LIMIT_BASE_SECONDS, max_delay=RATE_LIMIT_MAX_SECONDS):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.delay = 0
+        self.resume_at = 0
+        self.throttled_at = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """ blocks until the current back-off (if any) has passed, returns the time the request is sent """
+        while True:
+            with self.lock:
+                remaining = self.resume_at - time.time()
+            if remaining <= 0:
+                return time.time()
+            time.sleep(remaining)
+
+    def throttled(self, sent_at):
+        """ records a 429 for a request sent at $sent_at, returns the number of seconds to back off """
+        with self.lock:
+            if sent_at >= self.throttled_at:
+                self.delay = min(max(self.delay * 2, self.base_delay), self.max_delay)
+                self.throttled_at = time.time()
+                self.resume_at = self.throttled_at + self.delay
+            return max(self.resume_at - time.time(), 0)
+
+    def succeeded(self):
+        with self.lock:
+            self.delay = self.delay / 2 if self.delay > self.base_delay else 0
+
+class UploadStats(object):
+    """ aggregate counters for the uploads posted to the Box, used to report throughput """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ starts counting afresh, called when the first upload of a batch is submitted """
+        self.started = time.time()
+        self.files = 0
+        self.failed = 0
+        self.bytes = 0
+
+    def add(self, size, success):
+        with self.lock:
+            if success:
+                self.files += 1
+                self.bytes += size
+            else:
+                self.failed += 1
+
+    def mb_per_second(self):
+        elapsed = time.time() - self.started
+        return (self.bytes / 1e6) / elapsed if elapsed > 0 else 0.0
+
+    def log(self):
+        Log.info("uploaded %d files (%d failed), %.1f MB at %.2f MB/s",
+                self.files, self.failed, self.bytes / 1e6, self.mb_per_second())
+
+# shared by all uploads so that concurrent workers back off together
+BOX_RATE_LIMITER = AdaptiveRateLimiter()
+UPLOAD_STATS = UploadStats()
 
 def post_video_content(camera_name, camera_id, filepath, timestamp, host=None, port=None, location=None):
     """
@@ -302,70 +716,141 @@ def post_video_content(camera_name, camera_id, filepath, timestamp, host=None, p
     host, device_id = get_account_info()
     if not port:
         port = BATCH_IMPORT_DEFAULT_PORT
-    with open(filepath, 'rb') as fh:
-        filehash = hash_file_in_chunks(fh)
-    urlbase = "http://%s:%s" % (host, port)
-    urlbase = urlbase + "/box/content"
-    local_camera_id = hashlib.sha1(camera_name).hexdigest()
-    urlparams = "access_token=%s&local_camera_id=%s&camera_id=%s&hash=%s&timestamp=%s" % (
-        device_id, local_camera_id, camera_id, filehash, timestamp)
-    url = urlbase + "?" + urlparams
     if not os.path.exists(filepath):
         Log.error("unable to locate video-file: %s, continuing", filepath)
         return False
+    filehash = get_file_hash(filepath)
+    local_camera_id = hashlib.sha1(camera_name).hexdigest()
+    urlparams = "access_token=%s&local_camera_id=%s&camera_id=%s&hash=%s&timestamp=%s" % (
+        device_id, local_camera_id, camera_id, filehash, timestamp)
+    url = "http://%s:%s/box/content?%s" % (host, port, urlparams)
     Log.debug("posting video content: file=%s, camera=%s, timestamp=%s", filepath, camera_name, timestamp)
-    repsonse = None
+    response = None
     failed_attempts_left = 2 # 2 max failed attempts to contact server at all
     max_rate_limits_reached = 5 # 5 max back-off for space to open on Box
     rate_limit_reached_counter = 0
-    sleep_time = 15 # seconds to sleep when rate-limit hit
+    success = False
     while failed_attempts_left > 0:
         try:
+            sent_at = BOX_RATE_LIMITER.wait()
             with open(filepath, 'rb') as fh:
-                response = requests.post(url, data=fh)
+                response = get_session('box').post(url, data=fh, timeout=get_session_timeout('box'))
             if response.status_code in (200, 204):
-                return True
+                BOX_RATE_LIMITER.succeeded()
+                success = True
+                break
             elif response.status_code == 400:
                 # bad arguments or bad hash
-                logging.error("error returned from Box when posting video")
-                logging.error("%r: %r", response, response.text) 
-                return False
+                Log.error("error returned from Box when posting video")
+                Log.error("%r: %r", response, response.text) 
+                break
             elif response.status_code == 429:
-                # hit the rate-limiter, sleep for a while then try again. This
-                # isn't an error, we just need to slow down.
+                # hit the rate-limiter, back off for a while then try again. This
+                # isn't an error, we just need to slow down. The back-off is shared
+                # with every other upload in flight, see AdaptiveRateLimiter
                 rate_limit_reached_counter += 1
                 if rate_limit_reached_counter >= max_rate_limits_reached:
                     Log.error("unable to post content after %d retries, failing..", max_rate_limits_reached)
-                    return False
-                # exponential back-off on rate-limits, max waited = sum([15*(2^x) for x in range(0, 5)]) = 465 seconds
-                actual_sleep_time = sleep_time * (2 ** rate_limit_reached_counter)
+                    break
                 Log.info("reached rate-limit of Box web-server")
-                Log.info("sleeping for %d seconds before retrying..", actual_sleep_time)
-                time.sleep(actual_sleep_time)
+                Log.info("backing off for %d seconds before retrying..", BOX_RATE_LIMITER.throttled(sent_at))
         # this means we couldn't even contact the web-server, maybe it's taking some
         # time to wake up, so back off a bit
-        except requests.exceptions.ConnectionError, e:
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout), e:
             Log.error("connection error while contacting Box server")
             Log.error("sleeping to wait for server to wake up, %d more retries left", failed_attempts_left)
             Log.error(traceback.format_exc())
             failed_attempts_left -= 1
             time.sleep(30)
+            # the Box may have come back with a new IP address, look it up again
+            invalidate_box_state(device_id)
+            host, device_id = get_account_info()
+            url = "http://%s:%s/box/content?%s" % (host, port, urlparams)
+
+    UPLOAD_STATS.add(os.path.getsize(filepath), success)
+    return success
+
+def post_video_contents(items, host=None, port=None, concurrency=None):
+    """
+    arguments:
+        items       - an iterable of (camera_name, camera_id, filepath, timestamp) tuples
+        host, port  - passed through to post_video_content
+        concurrency - the number of uploads kept in flight to the Box (default: the 'upload_concurrency'
+                      hook-data value or UPLOAD_CONCURRENCY)
+    returns: a generator yielding (item, success) for each item as soon as its upload finishes, which
+             is not necessarily the order they were submitted in
+
+    description: batch counterpart of post_video_content. The uploads are spread over a pool of worker
+                 threads that share one keep-alive Box session and one rate limiter, so a 429 from the
+                 Box slows every worker down instead of stalling the whole import behind one clip.
+    """
+    if concurrency is None:
+        concurrency = int(CAMIO_PARAMS.get('upload_concurrency', UPLOAD_CONCURRENCY))
+    concurrency = max(concurrency, 1)
+    # the totals logged at the end are this call's, even when it has nothing to upload
+    UPLOAD_STATS.reset()
+    # resolve the Box address up front so the workers don't race on the device prompt
+    get_account_info()
+    pending = Queue.Queue(maxsize=concurrency * 2)
+    finished = Queue.Queue()
+
+    def worker():
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            try:
+                camera_name, camera_id, filepath, timestamp = item
+                success = post_video_content(camera_name, camera_id, filepath, timestamp, host=host, port=port)
+            # fail() raises SystemExit, which must not kill the worker before it hands back a result
+            except BaseException, e:
+                Log.error("unable to post video content: %r", item)
+                Log.error(traceback.format_exc())
+                success = False
+            finished.put((item, success))
 
-    return response and response.status_code in (200, 204)
+    workers = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+
+    submitted = 0
+    returned = 0
+    for item in items:
+        if not submitted:
+            # time the uploads themselves, not the hashing of a lazy $items that came before them
+            UPLOAD_STATS.reset()
+        # keep the queue topped up while handing back any results that are already available
+        while True:
+            try:
+                pending.put(item, timeout=0.1)
+                break
+            except Queue.Full:
+                while not finished.empty():
+                    returned += 1
+                    yield finished.get()
+        submitted += 1
+    for _ in workers:
+        pending.put(None)
+    while returned < submitted:
+        returned += 1
+        yield finished.get()
+    UPLOAD_STATS.log()
 
 def assign_job_ids(self, db, unscheduled):
-    item_count = len(unscheduled)
+    """ registers a job for the $unscheduled items and writes their shard assignments to $db. The items are
+    read twice, once for the job summary and once to assign them, so a single-use iterator is made a list """
+    if iter(unscheduled) is unscheduled:
+        unscheduled = list(unscheduled)
+    summary = JobSummary(unscheduled)
+    item_count = summary.item_count
     # if we have files to upload follow process in https://github.com/CamioCam/Camiolog-Web/issues/4555
     if item_count:        
-        earliest_date = min(params['timestamp'] for params in unscheduled)
-        latest_date = max(dateshift(params['timestamp'], params['duration']) 
-                for params in unscheduled)
+        earliest_date = summary.earliest_date
+        latest_date = summary.latest_date
         device_id = CAMIO_PARAMS.get('device_id')
         camio_account_token = get_access_token()
-        item_average_size_bytes = sum(len(json.dumps(
-                    {'key':params['key'], 
-                     'original_filename': params['filename'], 
-                     'size_MB': params['size']/1e6})) for params in unscheduled)/item_count
+        item_average_size_bytes = summary.item_average_size_bytes
         cameras = CAMIO_PARAMS.get('registered_cameras', {})
         payload = {
             'device_id':device_id, 
@@ -400,29 +885,119 @@ def assign_job_ids(self, db, unscheduled):
         # for debug only 
         for item in upload_urls:
             Log.debug("upload item: %r", item[0])
-        Log.debug('len(unscheduled)=%s', len(unscheduled))
+        Log.debug('len(unscheduled)=%s', item_count)
 
-        # for each new file to upload store the job_id and the upload_url from the proper shard
-        upload_urls_k = 0
-        total_urls = 0
+        # for each new file to upload store the job_id and the upload_url from the proper shard,
+        # item k belongs to the first shard whose cumulative item count is greater than k
+        shard_bounds = [item[0] for item in upload_urls]
+        batch_size = max(int(CAMIO_PARAMS.get('assign_batch_size', ASSIGN_BATCH_SIZE)), 1)
+        recover_assignments(db)
+        batch = {}
         for k, params in enumerate(unscheduled):        
             key = params['key']
             params['job_id'] = job_id
-            while k >= upload_urls[upload_urls_k][0]: 
-                Log.debug("upload_urls_k: %r", upload_urls_k)
-                upload_urls_k += 1
-            params['shard_id'] = upload_urls[upload_urls_k][1]
-            params['upload_url'] = upload_urls[upload_urls_k][2]
-            db[key] = params
-            db.sync()
+            _, params['shard_id'], params['upload_url'] = upload_urls[bisect.bisect_right(shard_bounds, k)]
+            batch[key] = params
+            get_shard_index().setdefault((job_id, params['shard_id']), []).append(key)
+            if len(batch) >= batch_size:
+                write_assignments(db, batch)
+                batch = {}
+        write_assignments(db, batch)
+        save_shard_index()
         return job_id
 
+def write_assignments(db, batch):
+    """ writes a batch of {key: params} to the db. The batch goes to the journal file first, and the
+    journal is only removed once the db has been synced, see recover_assignments """
+    if not batch:
+        return
+    journal = CAMIO_PARAMS.get('assign_journal_file', ASSIGN_JOURNAL_FILE)
+    with open(journal + '.tmp', 'wb') as fh:
+        cPickle.dump(batch, fh, cPickle.HIGHEST_PROTOCOL)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.rename(journal + '.tmp', journal)
+    for key, params in batch.iteritems():
+        db[key] = params
+    db.sync()
+    os.remove(journal)
+    Log.debug("wrote %d job assignments to the db", len(batch))
+
+def recover_assignments(db):
+    """ replays a batch of assignments left in the journal file by a crash in write_assignments """
+    journal = CAMIO_PARAMS.get('assign_journal_file', ASSIGN_JOURNAL_FILE)
+    if not os.path.exists(journal):
+        return
+    try:
+        with open(journal, 'rb') as fh:
+            batch = cPickle.load(fh)
+    except Exception, e:
+        # the journal is renamed into place only once complete, so this is a damaged file rather than a partial batch
+        Log.warn("discarding incomplete job-assignment journal: %s", journal)
+        os.remove(journal)
+        return
+    Log.info("recovering %d job assignments from journal: %s", len(batch), journal)
+    write_assignments(db, batch)
+
+def get_shard_index():
+    """ returns the {(job_id, shard_id): [db keys]} index, loading it from the shard-index file on first use """
+    global SHARD_INDEX
+    if SHARD_INDEX is None:
+        SHARD_INDEX = {}
+        filename = CAMIO_PARAMS.get('shard_index_file', SHARD_INDEX_FILE)
+        if os.path.exists(filename):
+            try:
+                with open(filename) as fh:
+                    for entry in json.load(fh):
+                        # shelve keys must be str, not the unicode returned by json
+                        SHARD_INDEX[(entry['job_id'], entry['shard_id'])] = [str(key) for key in entry['keys']]
+            except Exception, e:
+                Log.warn("unable to read shard index from %s, it will be rebuilt from the db", filename)
+                Log.debug(traceback.format_exc())
+    return SHARD_INDEX
+
+def save_shard_index():
+    filename = CAMIO_PARAMS.get('shard_index_file', SHARD_INDEX_FILE)
+    entries = [dict(job_id=job_id, shard_id=shard_id, keys=keys)
+            for (job_id, shard_id), keys in get_shard_index().items()]
+    with open(filename, 'w') as fh:
+        json.dump(entries, fh)
+
+def build_shard_index(db, jobs):
+    """ adds the (job_id, shard_id) pairs of $jobs to the shard index with a single pass over the db, used
+    when the index is missing entries (e.g. jobs assigned before the index existed) """
+    index = get_shard_index()
+    wanted = set(tuple(job) for job in jobs)
+    for job in wanted:
+        index[job] = []
+    for key, params in db.iteritems():
+        job = (params.get('job_id'), params.get('shard_id'))
+        if job in wanted:
+            index[job].append(key)
+    save_shard_index()
+
 def register_jobs(self, db, jobs):
     success = True
+    recover_assignments(db)
+    index = get_shard_index()
+    missing = [job for job in jobs if tuple(job) not in index]
+    if missing:
+        Log.info("shard index missing %d shards, rebuilding it from the db", len(missing))
+        build_shard_index(db, missing)
     for job_id, shard_id in jobs:
-        rows = filter(lambda params: \
-            (params['job_id'], params['shard_id']) == (job_id, shard_id), db.values()
-        )
+        # the index is only a hint: skip keys listed twice and rows that were since assigned to another shard
+        rows, seen = [], set()
+        for key in index[(job_id, shard_id)]:
+            if key in seen or key not in db:
+                continue
+            seen.add(key)
+            params = db[key]
+            if (params.get('job_id'), params.get('shard_id')) == (job_id, shard_id):
+                rows.append(params)
+        if not rows:
+            Log.error("no files found for job: %s, shard: %s", job_id, shard_id)
+            success = False
+            continue
         hash_map = {}
         for params in rows:
             hash_map[params['key']] = {
@@ -438,9 +1013,13 @@ def register_jobs(self, db, jobs):
                 job_id, shard_id, len(rows), hash_map)
         url = rows[0]['upload_url']
         ret = network_request('put', url, json=payload)
-        if not ret.status_code in (200, 204):
+        if ret is None:
+            Log.error("error registering job: %s, no response from server", job_id)
+            success = False
+        elif not ret.status_code in (200, 204):
             Log.error("error registering job: %s", job_id)
             Log.error("server returned: %d", ret.status_code)
             success = False
-        return success
+    log_connection_stats()
+    return success
 
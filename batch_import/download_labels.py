@@ -24,6 +24,15 @@ Example:
 
     which will write the list of jobs that belong to the user to the file '/tmp/job_list.json'
 
+    To download several jobs at once (or every job with a given status, with --status complete), writing one output file
+    per job to /tmp/labels and a manifest of all of them to /tmp/labels/manifest.json
+
+    python download_labels.py --workers 8 --max_rate 20 --output_dir /tmp/labels SjksdkjoowlkjlSDFiwjoijerSDRdsdf agpIDYggsM
+
+    To download a long job faster, split its time range into 32 windows and page through them with 8 concurrent workers
+
+    python download_labels.py --workers 8 --windows 32 SjksdkjoowlkjlSDFiwjoijerSDRdsdf
+
 """
 
 
@@ -33,18 +42,678 @@ import argparse
 import logging
 import traceback
 import json
+import re
+import random
+import email.utils
 import urllib
 import requests
 import dateutil.parser
+import dateutil.tz
 import textwrap
+import time
+import copy
+import collections
+import threading
+import sqlite3
+import csv
+import struct
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
 from datetime import datetime,timedelta
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
+UTC = dateutil.tz.tzutc()
+
 def fail(msg, *args):
     logging.error(msg, *args)
     sys.exit(1)
 
+def as_utc(date):
+    """ treat naive datetimes as UTC, the way the Camio API reports them """
+    if date.tzinfo is None:
+        return date.replace(tzinfo=UTC)
+    return date
+
+EPOCH = datetime(1970, 1, 1, tzinfo=UTC)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+# the timestamp formats used by the Camio API: 2016-10-09T05:00:37.000-0000, 2016-10-09T05:00:37.000+00:00,
+# 2016-10-09T05:00:37Z, or with no offset at all (UTC)
+ISO_TIMESTAMP = re.compile(r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?(Z|[+-]\d\d:?\d\d)?$')
+
+def epoch_microseconds(date):
+    """
+    the number of microseconds since the unix epoch of the timestamp string $date. The formats matched by
+    $ISO_TIMESTAMP are converted directly, anything else is parsed with dateutil
+    """
+    match = ISO_TIMESTAMP.match(date)
+    try:
+        year, month, day, hour, minute, second, fraction, offset = match.groups()
+        days = datetime(int(year), int(month), int(day)).toordinal() - EPOCH_ORDINAL
+    except (AttributeError, ValueError):
+        delta = as_utc(dateutil.parser.parse(date)) - EPOCH
+        return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    seconds = days * 86400 + int(hour) * 3600 + int(minute) * 60 + int(second)
+    if offset and offset != 'Z':
+        sign = -1 if offset[0] == '+' else 1
+        seconds += sign * (int(offset[1:3]) * 3600 + int(offset[-2:]) * 60)
+    return seconds * 1000000 + (int(fraction.ljust(6, '0')) if fraction else 0)
+
+def from_epoch_microseconds(micros):
+    """ the UTC datetime of $micros since the unix epoch """
+    return EPOCH + timedelta(microseconds=micros)
+
+def parse_timestamp(date):
+    """ parses the timestamp string $date into a UTC datetime, see epoch_microseconds """
+    return from_epoch_microseconds(epoch_microseconds(date))
+
+def format_timestamp(micros):
+    """
+    the canonical form of the timestamp $micros since the unix epoch, the way the Camio API usually writes
+    them (2016-10-09T05:00:37.000-0000), with microseconds only when they are not whole milliseconds
+    """
+    date = from_epoch_microseconds(micros)
+    if date.microsecond % 1000:
+        return date.strftime('%Y-%m-%dT%H:%M:%S.%f-0000')
+    return date.strftime('%Y-%m-%dT%H:%M:%S.') + '%03d-0000' % (date.microsecond // 1000)
+
+def canonical_timestamp(date):
+    """
+    the canonical form of the timestamp string $date, so that the same instant written in different formats
+    (-0000, +00:00, Z) is stored under a single key
+    """
+    if len(date) == 28 and date.endswith('-0000') and date[19] == '.' and ISO_TIMESTAMP.match(date):
+        return date
+    return format_timestamp(epoch_microseconds(date))
+
+class JsonLabelWriter(object):
+    """
+    writes the labels as a single indented json object once all of them have been gathered:
+    { "job_id": ..., "earliest_date": ..., "latest_date": ..., "labels": { date_created: { "labels": [...], "camera": {...} } } }
+    The other writers share this interface, write() may be called from several threads at once.
+    Writers that append to their output as they go (resumable = True) can be checkpointed and resumed.
+    """
+    resumable = False
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def open(self, header, offset=None, count=0):
+        """ starts the output, or with $offset continues a streamed output that already holds $count labels """
+        self.header = header
+        self.labels = dict()
+
+    def write(self, labels):
+        with self.lock:
+            self.labels.update(labels)
+            self.count = len(self.labels)
+
+    def close(self):
+        output = dict(self.header, labels=collections.OrderedDict(sorted(self.labels.items())))
+        with open(self.filename, 'w') as fh:
+            fh.write(json.dumps(output, indent=2))
+
+class StreamingJsonLabelWriter(JsonLabelWriter):
+    """ writes the same json object as JsonLabelWriter, but appends each page of labels to the file as it
+    arrives instead of keeping them in memory. The labels are in the order they were downloaded """
+    resumable = True
+
+    def open(self, header, offset=None, count=0):
+        if self.resume(offset, count):
+            return
+        self.fh = open(self.filename, 'w')
+        header = json.dumps(header, indent=2, sort_keys=True, separators=(',', ': '))
+        # leave the labels object open, entries are appended by write() and close() terminates it
+        self.fh.write(header[:header.rindex('}')].rstrip() + ',\n  "labels": {')
+
+    def resume(self, offset, count):
+        """ reopens the output for appending after the first $offset bytes, dropping anything written
+        after them (the labels of a page that was not checkpointed) """
+        if offset is None:
+            return False
+        self.fh = open(self.filename, 'r+b')
+        self.fh.truncate(offset)
+        self.fh.seek(offset)
+        self.count = count
+        return True
+
+    def tell(self):
+        return self.fh.tell()
+
+    def write(self, labels):
+        with self.lock:
+            for date, entry in labels.iteritems():
+                self.fh.write('%s\n    %s: %s' % (',' if self.count else '', json.dumps(date), json.dumps(entry)))
+                self.count += 1
+            self.fh.flush()
+
+    def close(self):
+        self.fh.write('\n  }\n}\n')
+        self.fh.close()
+
+class NdjsonLabelWriter(StreamingJsonLabelWriter):
+    """ writes one json object per line and per image: {"date_created": ..., "camera": {...}, "labels": [...]} """
+    def open(self, header, offset=None, count=0):
+        if not self.resume(offset, count):
+            self.fh = open(self.filename, 'w')
+
+    def write(self, labels):
+        with self.lock:
+            for date, entry in labels.iteritems():
+                self.fh.write(json.dumps(dict(entry, date_created=date)) + '\n')
+                self.count += 1
+            self.fh.flush()
+
+    def close(self):
+        self.fh.close()
+
+class CsvLabelWriter(StreamingJsonLabelWriter):
+    """ writes one csv row per (timestamp, camera, label), as labels arrive """
+    def open(self, header, offset=None, count=0):
+        if not self.resume(offset, count):
+            self.fh = open(self.filename, 'wb')
+            csv.writer(self.fh).writerow(['timestamp', 'camera', 'label'])
+        self.csv = csv.writer(self.fh)
+
+    def write(self, labels):
+        with self.lock:
+            for date, entry in labels.iteritems():
+                camera = entry['camera']['name'].encode('utf8')
+                self.csv.writerows([date, camera, label.encode('utf8')] for label in entry['labels'])
+                self.count += 1
+            self.fh.flush()
+
+    def close(self):
+        self.fh.close()
+
+COLUMNAR_MAGIC = 'CAMIOLBL'
+
+# default output file extension for each --format
+OUTPUT_EXTENSIONS = {'json': 'json', 'json-stream': 'json', 'ndjson': 'ndjson', 'csv': 'csv', 'columnar': 'lbl'}
+
+class ColumnarLabelWriter(JsonLabelWriter):
+    """
+    writes the labels in a compact columnar binary format with one row per (timestamp, camera, label):
+
+        COLUMNAR_MAGIC | header size (uint32) | header (json) | timestamp column | camera column | label column
+
+    The header holds the job information, the number of rows, the camera and label dictionaries and the offset,
+    length and struct format character of each column. Timestamps are int64 microseconds since the unix epoch, cameras and
+    labels are int32 indexes into their dictionaries, all little-endian, so the columns can be loaded directly with
+    numpy.frombuffer. See load_columnar_labels. The columns are spooled to temporary files while downloading so
+    only the dictionaries are kept in memory.
+    """
+    COLUMNS = [('timestamp', 'q'), ('camera', 'i'), ('label', 'i')]
+
+    def open(self, header, offset=None, count=0):
+        self.header = header
+        self.rows = 0
+        self.cameras = {}
+        self.labels = {}
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        self.spools = [tempfile.TemporaryFile(dir=directory) for _ in self.COLUMNS]
+
+    def encode(self, dictionary, value):
+        index = dictionary.get(value)
+        if index is None:
+            index = dictionary[value] = len(dictionary)
+        return index
+
+    def write(self, labels):
+        with self.lock:
+            columns = [[] for _ in self.COLUMNS]
+            for date, entry in labels.iteritems():
+                timestamp = epoch_microseconds(date)
+                camera = self.encode(self.cameras, entry['camera']['name'])
+                for label in entry['labels']:
+                    columns[0].append(timestamp)
+                    columns[1].append(camera)
+                    columns[2].append(self.encode(self.labels, label))
+                self.count += 1
+            for (name, typecode), column, spool in zip(self.COLUMNS, columns, self.spools):
+                spool.write(struct.pack('<%d%s' % (len(column), typecode), *column))
+            self.rows += len(columns[0])
+
+    def close(self):
+        header = dict(self.header, version=1, rows=self.rows,
+            cameras=sorted(self.cameras, key=self.cameras.get), labels=sorted(self.labels, key=self.labels.get), columns=[])
+        offset = 0
+        for (name, typecode), spool in zip(self.COLUMNS, self.spools):
+            length = spool.tell()
+            header['columns'].append(dict(name=name, format=typecode, offset=offset, length=length))
+            offset += length
+        encoded = json.dumps(header)
+        with open(self.filename, 'wb') as fh:
+            fh.write(COLUMNAR_MAGIC + struct.pack('<I', len(encoded)) + encoded)
+            for spool in self.spools:
+                spool.seek(0)
+                shutil.copyfileobj(spool, fh)
+                spool.close()
+
+def load_columnar_labels(filename):
+    """
+    reads a file written by ColumnarLabelWriter, returns its header with a 'data' entry mapping each column
+    name to a tuple of its values. For pandas, something like:
+
+        columns = load_columnar_labels(filename)
+        frame = pandas.DataFrame({
+            'timestamp': pandas.to_datetime(numpy.asarray(columns['data']['timestamp']), unit='us'),
+            'camera': pandas.Categorical.from_codes(columns['data']['camera'], columns['cameras']),
+            'label': pandas.Categorical.from_codes(columns['data']['label'], columns['labels']),
+        })
+    """
+    with open(filename, 'rb') as fh:
+        if fh.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+            raise ValueError("%s is not a columnar label file" % filename)
+        size, = struct.unpack('<I', fh.read(4))
+        header = json.loads(fh.read(size))
+        start = fh.tell()
+        header['data'] = {}
+        for column in header['columns']:
+            fh.seek(start + column['offset'])
+            count = column['length'] // struct.calcsize(str(column['format']))
+            header['data'][column['name']] = struct.unpack('<%d%s' % (count, column['format']), fh.read(column['length']))
+    return header
+
+class LabelCheckpoint(object):
+    """
+    the progress of a streamed label download, saved as json after every page so that an interrupted
+    download can continue with --resume. It records, for each time window, the start of the next page
+    to fetch (or that the window is done), and the size of the output and number of labels written so far.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.state = None
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return None
+        with open(self.filename) as fh:
+            self.state = json.load(fh)
+        return self.state
+
+    def start(self, job_id, output_format, windows):
+        self.state = dict(job_id=job_id, format=output_format, offset=None, count=0, windows=[
+            dict(start=start.isoformat(), end=end.isoformat(), cameras=cameras, is_last=is_last, next_start=start.isoformat(), done=False)
+            for (start, end, cameras, is_last) in windows
+        ])
+        self.save()
+
+    def get_windows(self):
+        """ the windows that are not done yet, each starting where its last checkpointed page left off """
+        return [(parse_timestamp(window['next_start']), parse_timestamp(window['end']), window['cameras'], window['is_last'])
+                for window in self.state['windows'] if not window['done']]
+
+    def find(self, window):
+        start, end, cameras, is_last = window
+        for entry in self.state['windows']:
+            if entry['end'] == end.isoformat() and entry['cameras'] == cameras:
+                return entry
+
+    def get_seen(self, window):
+        """ the dates of the last page written for $window, the next page starts with some of them again """
+        return set(self.find(window).get('seen', []))
+
+    def record(self, window, next_start, page, offset, count):
+        """ records that the labels of $window up to $next_start (None once the window is finished) are
+        in the first $offset bytes of the output, $page being the labels of the last page written """
+        entry = self.find(window)
+        entry['next_start'] = next_start.isoformat() if next_start else None
+        entry['done'] = next_start is None
+        entry['seen'] = list(page)
+        self.state['offset'] = offset
+        self.state['count'] = count
+        self.save()
+
+    def save(self):
+        with open(self.filename + '.tmp', 'w') as fh:
+            json.dump(self.state, fh)
+        if os.name == 'nt' and os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(self.filename + '.tmp', self.filename)
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+class LabelStore(object):
+    """
+    a local SQLite copy of the labels of a job, used by --sync to only download what is new since the last run.
+    It takes the place of the label writer while syncing: pages are merged into the store (newer labels replace
+    older ones for the same image and camera) and the output file is then written from the store.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.count = 0
+        self.added = 0
+        self.updated = 0
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS labels (date_created TEXT, camera TEXT, labels TEXT, "
+                        "PRIMARY KEY (date_created, camera))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+            self.db.commit()
+
+    def get_high_water_mark(self):
+        """ the date of the newest image stored by the last complete sync, or None """
+        value = self.get_meta('high_water_mark')
+        return parse_timestamp(value) if value else None
+
+    def update_high_water_mark(self):
+        row = self.db.execute("SELECT MAX(date_created) FROM labels").fetchone()
+        if row and row[0]:
+            self.set_meta('high_water_mark', row[0])
+
+    def open(self, header, offset=None, count=0):
+        self.count = self.db.execute("SELECT COUNT(*) FROM labels").fetchone()[0]
+
+    def write(self, labels):
+        with self.lock:
+            for date, entry in labels.iteritems():
+                camera = entry['camera']['name']
+                value = json.dumps(entry['labels'])
+                cursor = self.db.execute("INSERT OR IGNORE INTO labels (date_created, camera, labels) VALUES (?, ?, ?)",
+                        (date, camera, value))
+                if cursor.rowcount:
+                    self.added += 1
+                    continue
+                cursor = self.db.execute("UPDATE labels SET labels = ? WHERE date_created = ? AND camera = ? AND labels != ?",
+                        (value, date, camera, value))
+                self.updated += cursor.rowcount
+            self.db.commit()
+
+    def close(self):
+        self.db.commit()
+
+    def export(self, writer, header, batch_size=1000):
+        """ writes every stored label to $writer in timestamp order, a batch at a time """
+        writer.open(header)
+        cursor = self.db.execute("SELECT date_created, camera, labels FROM labels ORDER BY date_created")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            writer.write(collections.OrderedDict((date, {'labels': json.loads(labels), 'camera': {'name': camera}})
+                    for (date, camera, labels) in rows))
+        writer.close()
+
+class LabelFilter(object):
+    """
+    the label whitelist, precompiled for fast lookups. Entries ending in '*' match a family of labels by
+    prefix, e.g. "_ml_*" keeps every "_ml_..." label. An empty whitelist keeps every label.
+    Counts of the images and labels kept and dropped are collected to report the savings.
+    """
+    def __init__(self, white_labels):
+        self.exact = frozenset(label for label in white_labels if not label.endswith('*'))
+        self.prefixes = tuple(sorted(set(label[:-1] for label in white_labels if label.endswith('*'))))
+        self.lock = threading.Lock()
+        self.images_kept = self.images_dropped = self.labels_kept = self.labels_dropped = 0
+
+    def __nonzero__(self):
+        return bool(self.exact or self.prefixes)
+
+    def search_terms(self):
+        """ the whitelisted labels that can be sent along with the search query, prefixes can't """
+        return sorted(self.exact)
+
+    def filter(self, labels):
+        """ returns the whitelisted labels of $labels """
+        if not self:
+            return labels
+        exact, prefixes = self.exact, self.prefixes
+        if prefixes:
+            return [label for label in labels if label in exact or label.startswith(prefixes)]
+        return [label for label in labels if label in exact]
+
+    def count(self, images_kept, images_dropped, labels_kept, labels_dropped):
+        with self.lock:
+            self.images_kept += images_kept
+            self.images_dropped += images_dropped
+            self.labels_kept += labels_kept
+            self.labels_dropped += labels_dropped
+
+    def log(self):
+        if self:
+            logging.info("label whitelist kept %d images (%d labels), dropped %d images and %d labels",
+                    self.images_kept, self.labels_kept, self.images_dropped, self.labels_dropped)
+
+class RateLimiter(object):
+    """ caps the rate of requests made by all threads together to $rate per second (no cap if $rate is falsy) """
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+class ApiError(Exception):
+    """ raised when a request to the Camio servers still fails after all of its retries """
+    pass
+
+class CircuitOpenError(ApiError):
+    """ raised when a request used up its retries waiting for the circuit breaker to close """
+    pass
+
+class DownloadCancelled(Exception):
+    """ raised in the windows that are still downloading when another window of the job failed """
+    pass
+
+class CircuitBreaker(object):
+    """
+    stops sending requests after $threshold consecutive failures (5xx responses, connection errors or timeouts),
+    so that a server that is down is not hammered by every worker. After $reset_seconds one trial request is let
+    through while the others wait for its outcome: if it succeeds the breaker closes again, otherwise it stays
+    open for another $reset_seconds
+    """
+    def __init__(self, threshold=10, reset_seconds=30):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.condition = threading.Condition()
+
+    def wait(self, timeout):
+        """ waits up to $timeout seconds for the breaker to let a request through, returns False if it didn't """
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                if self.opened_at is None:
+                    return True
+                now = time.time()
+                trial_at = self.opened_at + self.reset_seconds
+                if not self.trial and now >= trial_at:
+                    # half-open: this request is the trial, the others wait until it succeeds or fails
+                    self.trial = True
+                    return True
+                if now >= deadline:
+                    return False
+                self.condition.wait(min(deadline, trial_at) - now if not self.trial else deadline - now)
+
+    def succeeded(self):
+        with self.condition:
+            if self.opened_at is not None:
+                logging.info("requests are succeeding again, closing the circuit breaker")
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+            self.condition.notify_all()
+
+    def failed(self):
+        with self.condition:
+            self.failures += 1
+            if self.failures >= self.threshold and self.opened_at is None:
+                logging.error("%d consecutive failed requests, opening the circuit breaker for %d s", self.failures, self.reset_seconds)
+            if self.failures >= self.threshold:
+                self.opened_at = time.time()
+            self.trial = False
+            self.condition.notify_all()
+
+class EndpointStats(object):
+    """ request, retry and latency counters of one endpoint """
+    def __init__(self):
+        self.requests = self.retries = self.failures = 0
+        self.seconds = self.max_seconds = 0.0
+
+    def add(self, seconds, retries, failed=False):
+        self.requests += 1
+        self.retries += retries
+        self.failures += 1 if failed else 0
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+class ApiClient(object):
+    """
+    the HTTP client shared by every worker of a download: a pooled keep-alive session with a timeout on each
+    request, retried on connection errors, timeouts and $RETRY_STATUSES with jittered exponential back-off.
+    A 429 waits for as long as its Retry-After header asks. Every attempt goes through $rate_limiter and the
+    circuit breaker, and the latency and retries are counted per endpoint (see log_stats)
+    """
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, pool_size=10, timeout=60, retries=5, backoff=1.0, max_backoff=60, rate_limiter=None, breaker=None):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.timeout = (min(timeout, 10), timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.breaker = breaker or CircuitBreaker()
+        self.stats = collections.defaultdict(EndpointStats)
+        self.lock = threading.Lock()
+
+    def get_retry_delay(self, attempt, response=None):
+        """ seconds to wait before retry #$attempt: the Retry-After of a 429, or a random share of the back-off """
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                date = email.utils.parsedate_tz(retry_after)
+                if date:
+                    return min(max(email.utils.mktime_tz(date) - time.time(), 0), self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def get(self, url, endpoint, headers=None):
+        """
+        GETs $url, retrying failures, and returns the response: any status that is not retried (including errors
+        like 401 or 404) is left for the caller to check. Raises ApiError once the retries are used up
+        """
+        started = time.time()
+        attempt = 0
+        while True:
+            # waiting for the circuit breaker to close takes the place of the back-off of a retry
+            if not self.breaker.wait(self.max_backoff):
+                if attempt >= self.retries:
+                    self.record(endpoint, time.time() - started, attempt, failed=True)
+                    raise CircuitOpenError("request to %s failed after %d attempts (the circuit breaker stayed open)" % (endpoint, attempt + 1))
+                attempt += 1
+                logging.warning("circuit breaker still open for the request to %s, retry %d of %d", endpoint, attempt, self.retries)
+                continue
+            self.rate_limiter.wait()
+            response = error = None
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout), e:
+                error = "%s: %s" % (type(e).__name__, e)
+            if response is not None and response.status_code not in self.RETRY_STATUSES:
+                self.breaker.succeeded()
+                self.record(endpoint, time.time() - started, attempt)
+                return response
+            if response is not None and response.status_code == 429:
+                # the server is up and only asking for fewer requests, which is what Retry-After is for
+                self.breaker.succeeded()
+            else:
+                self.breaker.failed()
+            if response is not None:
+                error = "status %d" % response.status_code
+            if attempt >= self.retries:
+                self.record(endpoint, time.time() - started, attempt, failed=True)
+                raise ApiError("request to %s failed after %d attempts (%s)" % (endpoint, attempt + 1, error))
+            delay = self.get_retry_delay(attempt, response)
+            attempt += 1
+            logging.warning("request to %s failed (%s), retry %d of %d in %.1f s", endpoint, error, attempt, self.retries, delay)
+            time.sleep(delay)
+
+    def record(self, endpoint, seconds, retries, failed=False):
+        with self.lock:
+            self.stats[endpoint].add(seconds, retries, failed)
+
+    def log_stats(self):
+        for endpoint, stats in sorted(self.stats.items()):
+            logging.info("%s: %d requests, %d retries, %d failed, latency %.3f s average, %.3f s max", endpoint,
+                    stats.requests, stats.retries, stats.failures, stats.seconds / stats.requests if stats.requests else 0, stats.max_seconds)
+
+class PageSizer(object):
+    """
+    adapts the number of results requested per search page. The size grows by half while full pages come back in
+    less than half of $target_latency seconds, and is halved after a page that takes longer than $target_latency
+    or fails, staying within [$min_size, $max_size]
+    """
+    def __init__(self, size=100, min_size=10, max_size=500, target_latency=2.0):
+        self.min_size = min(min_size, size)
+        self.max_size = max(max_size, size)
+        self.size = size
+        self.target_latency = target_latency
+        self.lock = threading.Lock()
+
+    def get(self):
+        return self.size
+
+    def record(self, requested, count, seconds, error=False):
+        """ adjusts the page size after a page of $requested results returned $count of them in $seconds """
+        with self.lock:
+            if error or seconds > self.target_latency:
+                self.size = max(self.min_size, min(self.size, requested) // 2)
+            elif count >= requested and seconds < self.target_latency / 2:
+                self.size = min(self.max_size, max(self.size, requested * 3 // 2))
+
+class PendingRequest(threading.Thread):
+    """ calls func(*args) in the background, so that the next page is on its way while the current one is handled """
+    def __init__(self, func, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.func = func
+        self.args = args
+        self.result = self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception, e:
+            self.error = sys.exc_info()
+
+    def get(self):
+        self.join()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
 class BatchDownloader(object):
 
     def __init__(self):
@@ -56,33 +725,84 @@ class BatchDownloader(object):
         self.job_id = None
         self.job = None
         self.white_labels = []
+        self.label_filter = LabelFilter([])
+        self.page_lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.checkpoint = None
+        self.rate_limiter = RateLimiter()
+        self.client = ApiClient(rate_limiter=self.rate_limiter)
+        self.page_sizer = PageSizer()
 
         self.parser = argparse.ArgumentParser(
             formatter_class=argparse.RawDescriptionHelpFormatter,
             description = textwrap.dedent(DESCRIPTION), epilog=EXAMPLES
         )
         # positional args
-        self.parser.add_argument('job_id', nargs='?', type=str, help='the ID of the job that you wish to download the labels for')
+        self.parser.add_argument('job_id', nargs='*', type=str, help='the ID of the job (or the IDs of the jobs) that you wish to download the labels for')
         # optional arguments
         self.parser.add_argument('-o', '--output_file', type=str, default=None,
                                 help="full path to the output file where the resulting labels will \
-                                be stored in json format (default = {{job_id}}_results.json)")
+                                be stored (default = {{job_id}}_results.json, or the extension of the chosen --format)")
         self.parser.add_argument('-a', '--access_token', type=str, help='your Camio OAuth token (if not given we check the CAMIO_OAUTH_TOKEN envvar)')
-        self.parser.add_argument('-w', '--label_white_list', type=str, help='a json list of labels that are whitelisted to be included in the response')
+        self.parser.add_argument('-w', '--label_white_list', type=str, help='a json list of labels that are whitelisted to be included in the response, \
+                                entries ending in * match every label starting with them (e.g. "_ml_*")')
         self.parser.add_argument('-f', '--label_white_list_file', type=str, help='a file containing a json list of labels that are whitelisted')
-        self.parser.add_argument('-c', '--csv', action='store_true', help='(not implemented yet) set to export in CSV format')
+        self.parser.add_argument('--format', choices=['json', 'json-stream', 'ndjson', 'csv', 'columnar'], default='json',
+                                help="output format: 'json' writes one indented json object at the end, 'json-stream' writes the \
+                                same object incrementally as labels arrive, 'ndjson' writes one json object per image and per line, \
+                                'csv' writes one row per timestamp, camera and label, 'columnar' writes the same rows in a compact \
+                                binary format (default = json)")
+        self.parser.add_argument('-r', '--resume', action='store_true',
+                                help='continue an interrupted download from its checkpoint file ({{output_file}}.checkpoint, streamed formats only)')
+        self.parser.add_argument('-s', '--sync', action='store_true',
+                                help='keep a local store of the labels of the job and only download what changed since the last sync')
+        self.parser.add_argument('--store_file', type=str, default=None,
+                                help='the SQLite file holding the local label store for --sync (default = {{output_dir}}/{{job_id}}_labels.sqlite)')
+        self.parser.add_argument('--sync_lookback', type=float, default=24,
+                                help='hours before the newest stored label to download again on --sync (default = 24)')
+        self.parser.add_argument('-c', '--csv', action='store_true', help='set to export in CSV format (same as --format csv)')
         self.parser.add_argument('-x', '--xml', action='store_true', help='(not implemented yet) set to export in XML format')
+        self.parser.add_argument('-n', '--workers', type=int, default=1, help='number of time windows to download concurrently (default = 1)')
+        self.parser.add_argument('--windows', type=int, default=None, help='number of time windows to split the job into (default = 4 per worker when using more than one worker)')
+        self.parser.add_argument('--split_cameras', action='store_true', help='also split each time window by camera')
+        self.parser.add_argument('--status', type=str, default=None,
+                                help='download the labels of every job of your account with this status (e.g. complete)')
+        self.parser.add_argument('--output_dir', type=str, default='.',
+                                help='directory for the output files when downloading more than one job, and for the --sync label stores (default = .)')
+        self.parser.add_argument('--max_rate', type=float, default=None,
+                                help='maximum number of requests per second to the Camio servers, across all workers (default = no limit)')
+        self.parser.add_argument('--timeout', type=float, default=60,
+                                help='seconds to wait for a response from the Camio servers before retrying (default = 60)')
+        self.parser.add_argument('--retries', type=int, default=5,
+                                help='number of times a failed request is retried before giving up (default = 5)')
+        self.parser.add_argument('--page_size', type=int, default=100,
+                                help='number of search results requested per page at the start (default = 100)')
+        self.parser.add_argument('--max_page_size', type=int, default=500,
+                                help='largest page size to grow to while the server responds quickly, '
+                                'set it to --page_size to keep the page size fixed (default = 500)')
+        self.parser.add_argument('--target_latency', type=float, default=2.0,
+                                help='seconds per page above which the page size is reduced (default = 2.0)')
+        self.parser.add_argument('--no_prefetch', action='store_true', default=False,
+                                help='wait for each page to be handled before requesting the next one')
         self.parser.add_argument('-t', '--testing', action='store_true', help="use Camio testing servers instead of production (for dev use only!)")
         self.parser.add_argument('-v', '--verbose', action='store_true', default=False, help='set logging level to debug')
         self.parser.add_argument('-q', '--quiet', action='store_true', default=False, help='set logging level to errors only')
 
     def parse_argv_or_exit(self):
         self.args = self.parser.parse_args()
-        if not self.args.job_id:
+        if not self.args.job_id and not self.args.status:
             logging.info("no job_id specified, getting list of jobs")
-        self.job_id = self.args.job_id
+        self.job_ids = self.args.job_id
+        self.job_id = self.job_ids[0] if len(self.job_ids) == 1 and not self.args.status else None
+        self.rate_limiter = RateLimiter(self.args.max_rate)
+        # a connection per worker, plus one for the page each of them prefetches
+        self.client = ApiClient(pool_size=max(self.args.workers * 2, 10), timeout=self.args.timeout,
+                retries=self.args.retries, rate_limiter=self.rate_limiter)
+        self.page_sizer = PageSizer(self.args.page_size, max_size=self.args.max_page_size, target_latency=self.args.target_latency)
+        if self.args.csv:
+            self.args.format = 'csv'
         if not self.args.output_file and self.job_id:
-            self.results_file = "%s_results.json" % self.job_id
+            self.results_file = "%s_results.%s" % (self.job_id, OUTPUT_EXTENSIONS[self.args.format])
         elif not self.args.output_file:
             self.results_file = "job_list.json"
         else:
@@ -97,7 +817,7 @@ class BatchDownloader(object):
             logging.getLogger().setLevel(logging.ERROR)
         if self.args.label_white_list:
             try:
-                self.white_labels += json.loads(self.args.white_label_list)
+                self.white_labels += json.loads(self.args.label_white_list)
             except:
                 logging.error("unable to deserialize label white-list")
                 logging.error(traceback.format_exc())
@@ -108,7 +828,7 @@ class BatchDownloader(object):
             except:
                 logging.error("unable to deserialize label white-list from file: %s", self.args.label_white_list_file)
                 logging.error(traceback.format_exc())
-                
+        self.label_filter = LabelFilter(self.white_labels)
         return self.args
 
     def get_access_token(self):
@@ -120,14 +840,21 @@ class BatchDownloader(object):
             self.access_token = token
         return self.access_token
 
-    def gather_all_job_data(self):
-        """ GET /api/jobs to list all job data to user """
+    def get_all_jobs(self):
+        """ GET /api/jobs to list all the jobs of the account """
         headers = {"Authorization": "token %s" % self.get_access_token() }
         logging.debug("making GET request to endpoint %s, headers: %r", self.get_job_url(), headers)
-        ret = requests.get(self.get_job_url(), headers=headers)
+        try:
+            ret = self.client.get(self.get_job_url(), 'jobs', headers=headers)
+        except ApiError, e:
+            fail("unable to obtain the list of jobs from %s endpoint: %s", self.get_job_url(), e)
         if not ret.status_code in (200, 204):
             fail("unable to obtain job resource with id: %s from %s endpoint. return code: %r", self.job_id, self.get_job_url(), ret.status_code)
-        parsed = ret.json()
+        return ret.json()
+
+    def gather_all_job_data(self):
+        """ GET /api/jobs to list all job data to user """
+        parsed = self.get_all_jobs()
         jobs = { job['job_id']: {
                     "start_time": job['request'].get('earliest_date'), 
                     "end_time": job['request'].get('latest_date'),
@@ -152,24 +879,27 @@ class BatchDownloader(object):
         else:
             return "%s/%s" % (self.CAMIO_SERVER_URL, self.CAMIO_JOBS_EDNPOINT)
 
-    def get_search_url(self, text, date=None):
+    def get_search_url(self, text, date=None, num_results=100):
         endpoint = self.CAMIO_SERVER_URL + "/" + self.CAMIO_SEARCH_ENDPOINT
+        params = [('text', text), ('num_results', num_results)]
         if date:
-            return "%s?text=%s&num_results=100&date=%s" % (endpoint, text, date.isoformat())
-        else:
-            return "%s?text=%s&num_results=100" %(endpoint, text)
+            params.append(('date', date.isoformat()))
+        return "%s?%s" % (endpoint, urllib.urlencode(params))
 
     def gather_job_data(self):
         headers = {"Authorization": "token %s" % self.get_access_token() }
         logging.debug("making GET request to endpoint %s, headers: %r", self.get_job_url(), headers)
-        ret = requests.get(self.get_job_url(), headers=headers)
+        try:
+            ret = self.client.get(self.get_job_url(), 'jobs', headers=headers)
+        except ApiError, e:
+            fail("unable to obtain job resource with id: %s from %s endpoint: %s", self.job_id, self.get_job_url(), e)
         if not ret.status_code in (200, 204):
             fail("unable to obtain job resource with id: %s from %s endpoint. return code: %r", self.job_id, self.get_job_url(), ret.status_code)
         logging.debug("got job-information returned from server:\n%r", ret.text)
         self.job = ret.json()
         self.earliest_date, self.latest_date = self.job['request']['earliest_date'], self.job['request']['latest_date']
-        self.earliest_datetime = dateutil.parser.parse(self.earliest_date)
-        self.latest_datetime = dateutil.parser.parse(self.latest_date)
+        self.earliest_datetime = parse_timestamp(self.earliest_date)
+        self.latest_datetime = parse_timestamp(self.latest_date)
         logging.debug("earliest datetime: %r, latest datetime: %r", self.earliest_datetime, self.latest_datetime)
         self.cameras = [camera['name'] for camera in self.job['request']['cameras']]
         logging.info("Job Definition:")
@@ -179,89 +909,361 @@ class BatchDownloader(object):
 
     def make_search_request(self, text, date=None):
         headers = {"Authorization": "token %s" % self.get_access_token() }
-        url = self.get_search_url(text, date)
-        ret = requests.get(url, headers=headers)
+        num_results = self.page_sizer.get()
+        url = self.get_search_url(text, date, num_results)
+        request_time = time.time()
+        try:
+            ret = self.client.get(url, 'search', headers=headers)
+        except ApiError, e:
+            self.page_sizer.record(num_results, 0, time.time() - request_time, error=True)
+            logging.error("unable to obtain search results with query (%s): %s", text, e)
+            raise
+        seconds = time.time() - request_time
         if not ret.status_code in (200, 204):
-            logging.error("unable to obtain search results with query (%s)", text)
+            logging.error("unable to obtain search results with query (%s), return code: %r", text, ret.status_code)
+            logging.debug("actual response: %r", ret.text)
+            self.page_sizer.record(num_results, 0, seconds, error=True)
+            # a window must never end quietly on a failed page, the run would succeed with a gap in the labels
+            raise ApiError("search request with query (%s) failed, return code: %r" % (text, ret.status_code))
         logging.debug("got search results for query (%s)", text)
         logging.debug("results:\n%r", ret.text)
         try:
-            return ret.json()
+            parsed = ret.json()
         except Exception, e:
             logging.error("error while decoding json response from the server")
             logging.debug("actual response: %r", ret.text)
-            return None
+            raise ApiError("undecodable search response for query (%s): %s" % (text, e))
+        buckets = (parsed.get('result') or {}).get('buckets') or []
+        count = sum(len(bucket.get('images') or []) for bucket in buckets)
+        self.page_sizer.record(num_results, count, seconds)
+        logging.info("page of %d/%d results in %.3f s (%.1f results/s), next page size: %d",
+                count, num_results, seconds, count / seconds if seconds else 0, self.page_sizer.get())
+        return parsed
 
-    def get_results_from_epoch(self, start_time, end_time, camera_names):
-        end_time = dateutil.parser.parse(end_time.isoformat() + "+00:00")
-        start_time = dateutil.parser.parse(start_time.isoformat() + "+00:00") 
+    def get_results_from_epoch(self, start_time, end_time, camera_names, on_page=None, clip_end=False, seen=None):
+        """
+        pages through the search results for $camera_names from $start_time until $end_time.
+        on_page  - if given, called as on_page(labels, next_start) with the labels of each page as soon as it
+                   arrives and the start time of the following page (None after the last page), in which case
+                   nothing is accumulated and an empty dict is returned
+        clip_end - drop the images at or after $end_time, used for all but the last of a set of
+                   consecutive windows so that the windows don't overlap
+        seen     - dates of images already handled that the first page should skip (when resuming)
+        """
+        end_time = as_utc(end_time)
+        start_time = as_utc(start_time)
+        end_micros = epoch_microseconds(end_time.isoformat())
         more_results = True
         labels = dict()
+        previous_page = seen or set()
+        text = " ".join(camera_names)
+        text = "all " + text
+        text = text + " " + " ".join(self.label_filter.search_terms())
+        pending = None
         while more_results:
-            text = " ".join(camera_names)
-            text = "all " + text
-            text = text + " " + " ".join(self.white_labels)
-            ret = self.make_search_request(text, start_time)
+            if self.cancelled.is_set():
+                raise DownloadCancelled("download of job %s cancelled" % self.job_id)
+            ret = pending.get() if pending else self.make_search_request(text, start_time)
+            pending = None
             if not ret or not ret.get('result'):
                 logging.error("invalid search response from the server")
                 break
             results = ret.get('result')
+            # see if there are more results and if so shift the start time of the query to reflect the new range
+            more_results = results.get('more_results', False)
+            if more_results and results.get('latest_date_considered'): 
+                new_start_time = parse_timestamp(results.get('latest_date_considered'))
+                if new_start_time == start_time: more_results = False
+                elif new_start_time >= end_time: more_results = False
+                else: start_time = new_start_time
+            
+                logging.info("results gathered, new starting time: %r", start_time.isoformat())
+            # the start of the next page is known, so request it while this one is handled
+            if more_results and not self.args.no_prefetch:
+                pending = PendingRequest(self.make_search_request, text, start_time)
+            page = collections.OrderedDict()
+            images_dropped = labels_kept = labels_dropped = 0
+            handled = set()
+            # the images at or after the end of the window belong to the next one, which counts them too
+            clip = clip_end and not more_results
             logging.debug("gathering labels from %d buckets", len(results.get('buckets', [])))
             for index, bucket in enumerate(results.get('buckets')):
                 logging.debug("bucket #%d - for date (%s) found labels: %r", index, bucket['earliest_date'], bucket.get('labels'))
                 for frameidx, image in enumerate(bucket.get('images')):
                     logging.debug("\timage #%d - for date (%s) found labels: %r", frameidx, image['date_created'], image.get('labels'))
-                    if labels.get(image['date_created']):
+                    date = canonical_timestamp(image['date_created'])
+                    if clip and epoch_microseconds(date) >= end_micros:
+                        continue
+                    # each page starts at the last date of the previous one, so skip the images already seen,
+                    # including the ones that were dropped, so that they are not counted twice
+                    if date in previous_page or date in handled:
                         logging.debug("WARN - duplicate timestamps found, possible bug in iteration")
+                        continue
+                    handled.add(date)
                     if not image.get('labels') or len(image['labels']) == 0:
                         continue
-                    new_labels = image['labels']
-                    #if self.white_labels: new_labels = [label for label in new_labels if label in self.white_labels]
-                    labels[image['date_created']] = {
+                    new_labels = self.label_filter.filter(image['labels'])
+                    labels_kept += len(new_labels)
+                    labels_dropped += len(image['labels']) - len(new_labels)
+                    if not new_labels:
+                        images_dropped += 1
+                        continue
+                    page[date] = {
                         'labels': new_labels,
                         'camera': {
                             'name': image['source']
                         },
                     }
-            # see if there are more results and if so shift the start time of the query to reflect the new range
-            more_results = results.get('more_results', False)
-            if more_results and results.get('latest_date_considered'): 
-                new_start_time = dateutil.parser.parse(results.get('latest_date_considered'))
-                if new_start_time == start_time: more_results = False
-                elif new_start_time >= end_time: more_results = False
-                else: start_time = new_start_time
-            
-                logging.info("results gathered, new starting time: %r", start_time.isoformat())
+            self.label_filter.count(len(page), images_dropped, labels_kept, labels_dropped)
+            previous_page = handled
+            if on_page:
+                on_page(page, start_time if more_results else None)
+            else:
+                labels.update(page)
         return labels
 
-    def gather_labels_batch(self):
+    def split_time_range(self, start, end, count):
+        """ split [start, end] into $count consecutive windows of equal length """
+        step = (end - start) / count
+        return [(start + step * index, end if index == count - 1 else start + step * (index + 1)) for index in range(count)]
+
+    def get_windows(self, start=None):
+        """ returns the list of (start, end, camera_names, is_last) windows to page through for the job,
+        from $start (default = the start of the job) until the end of the job """
+        count = max(self.args.windows or (self.args.workers * 4 if self.args.workers > 1 else 1), 1)
+        windows = self.split_time_range(as_utc(start or self.earliest_datetime), as_utc(self.latest_datetime), count)
+        windows = [(start, end, index == count - 1) for (index, (start, end)) in enumerate(windows)]
+        if self.args.split_cameras:
+            return [(start, end, [camera], is_last) for (start, end, is_last) in windows for camera in self.cameras]
+        return [(start, end, self.cameras, is_last) for (start, end, is_last) in windows]
+
+    def get_results_from_window(self, window):
+        start, end, camera_names, is_last = window
+        logging.info("gathering over time slot: %r to %r for cameras: %s", start.isoformat(), end.isoformat(), " ".join(camera_names))
+        on_page = lambda page, next_start: self.handle_page(window, page, next_start)
+        seen = self.checkpoint.get_seen(window) if self.checkpoint else None
+        self.get_results_from_epoch(start, end, camera_names, on_page=on_page, clip_end=not is_last, seen=seen)
+        return window
+
+    def handle_page(self, window, page, next_start):
+        """ writes a page of labels and checkpoints the progress of its window """
+        with self.page_lock:
+            self.writer.write(page)
+            if self.checkpoint:
+                self.checkpoint.record(window, next_start, page, self.writer.tell(), self.writer.count)
+
+    def gather_labels_parallel(self, windows):
+        """ pages through each window concurrently, handing each page to the label writer as it arrives """
+        pool = ThreadPool(self.args.workers)
+        try:
+            for index, window in enumerate(pool.imap_unordered(self.get_results_from_window, windows)):
+                logging.info("finished %d of %d time windows", index + 1, len(windows))
+            pool.close()
+        except:
+            # the run fails anyway, so stop the other windows at their next page instead of downloading them
+            self.cancelled.set()
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def gather_labels_batch(self, windows):
         start, end = self.earliest_datetime, self.latest_datetime
-        labels = dict(job_id=self.job_id, earliest_date=self.earliest_date, latest_date=self.latest_date, labels={})
-        logging.info("gathering over time slot: %r to %r", start.isoformat(), end.isoformat())
-        subset_labels = self.get_results_from_epoch(start, end, self.cameras)
-        labels['labels'].update(subset_labels)
-        logging.debug("\nall found labels:\n%r", json.dumps(labels))
+        if len(windows) == 1:
+            self.get_results_from_window(windows[0])
+        elif windows:
+            logging.info("gathering over time slot: %r to %r in %d windows with %d workers", start.isoformat(), end.isoformat(), len(windows), self.args.workers)
+            self.gather_labels_parallel(windows)
         logging.info("finished gathering labels")
-        return labels
+        self.label_filter.log()
 
-    def dump_labels_to_file(self):
-        logging.info("writing label info to file: %s", self.results_file)
-        with open(self.results_file, 'w') as fh:
-            fh.write(json.dumps(self.labels, indent=2))
+    def start_or_resume(self):
+        """ opens the label writer and returns the windows left to download, picking up from the checkpoint
+        file when resuming. Only the streamed formats can be checkpointed """
+        header = dict(job_id=self.job_id, earliest_date=self.earliest_date, latest_date=self.latest_date)
+        self.checkpoint = None
+        if not self.writer.resumable:
+            if self.args.resume:
+                fail("--resume requires a streamed output format (--format json-stream, ndjson or csv)")
+            self.writer.open(header)
+            return self.get_windows()
+        self.checkpoint = LabelCheckpoint(self.results_file + '.checkpoint')
+        state = self.checkpoint.load() if self.args.resume else None
+        if state:
+            if state['job_id'] != self.job_id or state['format'] != self.args.format:
+                fail("checkpoint %s is for job %s in %s format, not job %s in %s format", self.checkpoint.filename,
+                        state['job_id'], state['format'], self.job_id, self.args.format)
+            windows = self.checkpoint.get_windows()
+            logging.info("resuming download with %d labels already written, %d time windows left", state['count'], len(windows))
+            self.writer.open(header, offset=state['offset'], count=state['count'])
+            return windows
+        if self.args.resume:
+            logging.info("no checkpoint found at %s, starting from the beginning", self.checkpoint.filename)
+        windows = self.get_windows()
+        self.writer.open(header)
+        self.checkpoint.start(self.job_id, self.args.format, windows)
+        return windows
+
+    def get_label_writer(self):
+        writers = {'json': JsonLabelWriter, 'json-stream': StreamingJsonLabelWriter, 'ndjson': NdjsonLabelWriter,
+                'csv': CsvLabelWriter, 'columnar': ColumnarLabelWriter}
+        return writers[self.args.format](self.results_file)
+
+    def sync_labels(self):
+        """
+        brings the local label store of the job up to date and writes the output file from it. Only the part of the
+        job after the high-water mark of the previous sync is downloaded again, minus --sync_lookback hours to pick
+        up the labels that hooks added to recent events after the previous sync.
+        """
+        self.gather_labels_batch(self.start_sync())
+        self.finish_sync()
         logging.info("labels are now available in: %s", self.results_file)
 
+    def start_sync(self):
+        """ opens the label store of the job as its label writer and returns the windows to download into it """
+        store_file = self.args.store_file or os.path.join(self.args.output_dir, "%s_labels.sqlite" % self.job_id)
+        store = LabelStore(store_file)
+        high_water_mark = store.get_high_water_mark()
+        start = as_utc(self.earliest_datetime)
+        if high_water_mark:
+            start = max(start, as_utc(high_water_mark) - timedelta(hours=self.args.sync_lookback))
+        self.writer = store
+        store.open(None)
+        logging.info("syncing labels into %s from %s (%d labels stored)", store_file, start.isoformat(), store.count)
+        return self.get_windows(start) if start < as_utc(self.latest_datetime) else []
+
+    def finish_sync(self):
+        """ moves the high-water mark of the store once its windows are downloaded and writes the output file
+        from it, the label writer of the output file then replaces the store """
+        store = self.writer
+        store.update_high_water_mark()
+        logging.info("sync added %d and updated %d labels", store.added, store.updated)
+        logging.info("writing label info to file: %s", self.results_file)
+        header = dict(job_id=self.job_id, earliest_date=self.earliest_date, latest_date=self.latest_date)
+        self.writer = self.get_label_writer()
+        store.export(self.writer, header)
+        store.close()
+
+    def for_job(self, job_id):
+        """ returns a downloader for $job_id that shares the arguments, token, whitelist and rate limit of this one """
+        downloader = copy.copy(self)
+        downloader.job_id = job_id
+        downloader.job = None
+        downloader.writer = None
+        downloader.checkpoint = None
+        downloader.page_lock = threading.Lock()
+        downloader.cancelled = threading.Event()
+        downloader.results_file = os.path.join(self.args.output_dir, "%s_results.%s" % (job_id, OUTPUT_EXTENSIONS[self.args.format]))
+        return downloader
+
+    def download_jobs(self, job_ids):
+        """
+        downloads the labels of several jobs at once. The time windows of all the jobs go through a single pool of
+        --workers threads, each job is written to its own file in --output_dir, and a manifest describing all of
+        them is written to --output_file (default = <output_dir>/manifest.json)
+        """
+        if self.args.sync and self.args.store_file and len(job_ids) > 1:
+            fail("--store_file holds the labels of a single job, leave it out to keep a store per job in --output_dir")
+        if not os.path.isdir(self.args.output_dir):
+            os.makedirs(self.args.output_dir)
+        manifest = collections.OrderedDict()
+        tasks = []
+        remaining = {}
+        for job_id in job_ids:
+            downloader = self.for_job(job_id)
+            entry = manifest[job_id] = dict(job_id=job_id, output_file=downloader.results_file, status='pending')
+            try:
+                downloader.gather_job_data()
+                entry.update(earliest_date=downloader.earliest_date, latest_date=downloader.latest_date)
+                if self.args.sync:
+                    windows = downloader.start_sync()
+                else:
+                    downloader.writer = downloader.get_label_writer()
+                    windows = downloader.start_or_resume()
+            except (Exception, SystemExit), e:
+                logging.error("unable to start downloading job: %s", job_id)
+                logging.error(traceback.format_exc())
+                entry['status'] = 'error'
+                continue
+            remaining[job_id] = len(windows)
+            tasks += [(downloader, window) for window in windows]
+            if not windows:
+                self.finish_job(downloader, entry)
+
+        def run_task(task):
+            downloader, window = task
+            try:
+                downloader.get_results_from_window(window)
+                return downloader, None
+            except Exception, e:
+                return downloader, traceback.format_exc()
+
+        logging.info("downloading %d jobs in %d time windows with %d workers", len(remaining), len(tasks), self.args.workers)
+        pool = ThreadPool(self.args.workers)
+        try:
+            for downloader, error in pool.imap_unordered(run_task, tasks):
+                entry = manifest[downloader.job_id]
+                if error:
+                    logging.error("error while downloading job: %s\n%s", downloader.job_id, error)
+                    entry['status'] = 'error'
+                remaining[downloader.job_id] -= 1
+                if not remaining[downloader.job_id] and entry['status'] != 'error':
+                    self.finish_job(downloader, entry)
+        finally:
+            pool.close()
+            pool.join()
+        self.label_filter.log()
+
+        manifest_file = self.args.output_file or os.path.join(self.args.output_dir, 'manifest.json')
+        with open(manifest_file, 'w') as fh:
+            fh.write(json.dumps(manifest.values(), indent=2))
+        failed = [job_id for job_id in manifest if manifest[job_id]['status'] == 'error']
+        logging.info("downloaded %d of %d jobs, manifest written to: %s", len(manifest) - len(failed), len(manifest), manifest_file)
+        if failed:
+            fail("failed to download jobs: %s", " ".join(failed))
+
+    def finish_job(self, downloader, entry):
+        if self.args.sync:
+            downloader.finish_sync()
+        else:
+            downloader.writer.close()
+        if downloader.checkpoint:
+            downloader.checkpoint.remove()
+        entry.update(status='complete', label_count=downloader.writer.count)
+        logging.info("labels of job %s are now available in: %s", downloader.job_id, downloader.results_file)
+
     def run(self):
         try:
             self.parse_argv_or_exit()
+            if self.args.status:
+                self.job_ids += [job['job_id'] for job in self.get_all_jobs()
+                        if job['status'] == self.args.status and job['job_id'] not in self.job_ids]
+                logging.info("found %d jobs with status: %s", len(self.job_ids), self.args.status)
+            if len(self.job_ids) > 1 or self.args.status:
+                self.download_jobs(self.job_ids)
+                return True
             if not self.job_id:
                 self.gather_all_job_data()
             self.job = self.gather_job_data()
-            self.labels = self.gather_labels_batch()
-            self.dump_labels_to_file()
+            if self.args.sync:
+                self.sync_labels()
+                return True
+            self.writer = self.get_label_writer()
+            logging.info("writing label info to file: %s", self.results_file)
+            windows = self.start_or_resume()
+            self.gather_labels_batch(windows)
+            self.writer.close()
+            if self.checkpoint:
+                self.checkpoint.remove()
+            logging.info("labels are now available in: %s", self.results_file)
         except Exception, e:
             logging.error("exception during main program flow")
             logging.error(traceback.format_exc())
+            if getattr(self, 'checkpoint', None):
+                logging.error("progress was saved to %s, run again with --resume to continue", self.checkpoint.filename)
             sys.exit(1)
+        finally:
+            self.client.log_stats()
         return  True
 
 def main():
@@ -14,34 +14,257 @@ import requests
 import time
 import logging
 import traceback
+import socket
+import threading
+import argparse
+import multiprocessing
+import multiprocessing.sharedctypes
+import ctypes
+import collections
+import decimal
+import hashlib
+import tempfile
+import random
+import sqlite3
+import numpy
 try:
     from PIL import Image
 except ImportError:
     import Image
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 API_KEY = '123456789'
 
-connection = pymongo.MongoClient()
-db = connection['mydb']
-tasks = db['tasks']
+# how the background process learns about new tasks:
+# 'capped' - post_task also writes a small event to a capped collection, which the worker tails with an
+#            awaiting cursor so that it wakes up as soon as a task is queued
+# 'poll'   - the worker checks for pending tasks every POLL_SECONDS
+QUEUE_BACKEND = os.environ.get('HOOK_QUEUE_BACKEND', 'capped')
+POLL_SECONDS = 10
+EVENTS_COLLECTION_BYTES = 1 << 20
+
+# a worker claims a task by setting it 'in_progress' with a lease that expires after LEASE_SECONDS, and renews it
+# every HEARTBEAT_SECONDS while labeling. Tasks whose lease has expired (their worker died) are put back to
+# 'pending', or set to 'error' once they have been claimed MAX_ATTEMPTS times
+LEASE_SECONDS = 60
+HEARTBEAT_SECONDS = 20
+MAX_ATTEMPTS = 3
+# number of worker processes started by `python hook-example.py` per cpu core
+WORKERS_PER_CORE = 1
+
+# images are decoded and resized to MODEL_SIZE (width, height) and handed to label_batch BATCH_SIZE at a time.
+# A worker claims up to TASKS_PER_BATCH pending tasks at once, so that the images of small events share a batch
+MODEL_SIZE = (224, 224)
+BATCH_SIZE = 32
+TASKS_PER_BATCH = 8
+
+# the labels are posted back to Camio from a 'callbacks' collection by CALLBACK_THREADS threads of each worker, so
+# that labeling never waits on the network. A post that fails is retried after CALLBACK_BACKOFF_SECONDS, doubling
+# up to CALLBACK_MAX_BACKOFF_SECONDS, and is given up (the task is set to 'error') after CALLBACK_MAX_ATTEMPTS
+CALLBACK_THREADS = 4
+CALLBACK_TIMEOUT_SECONDS = (5, 30)
+CALLBACK_MAX_ATTEMPTS = 8
+CALLBACK_BACKOFF_SECONDS = 5
+CALLBACK_MAX_BACKOFF_SECONDS = 600
+
+# the labels of each image are cached by the sha1 of its bytes and MODEL_VERSION, so that images that Camio sends
+# again (overlapping events, re-queries) skip decoding and labeling. Each worker keeps the LABEL_CACHE_SIZE most
+# recently used labels in memory and, if HOOK_LABEL_CACHE_FILE is set, in an sqlite file shared by the workers
+# of the host and kept across restarts. Change MODEL_VERSION whenever label_batch changes
+MODEL_VERSION = 'example-1'
+LABEL_CACHE_SIZE = 10000
+LABEL_CACHE_FILE = os.environ.get('HOOK_LABEL_CACHE_FILE')
+
+# post_task writes the decoded images to SPOOL_DIR, named by the sha1 of their bytes, and queues a task that only
+# refers to them. Blobs that no task has used for SPOOL_RETENTION_SECONDS, and that no unfinished task refers to,
+# are removed by the workers. The workers read the images from it too, so workers on other hosts than the web server
+# need HOOK_SPOOL_DIR to be a filesystem shared with it
+SPOOL_DIR = os.environ.get('HOOK_SPOOL_DIR', '/tmp/hook-spool')
+SPOOL_RETENTION_SECONDS = 24 * 3600
+
+connection = db = tasks = callbacks = notifier = None
+
+class PollingNotifier(object):
+    """ the worker just sleeps for POLL_SECONDS between checks for pending tasks """
+    def notify(self, task_id):
+        pass
+
+    def listen(self):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return False
+
+class CappedCollectionNotifier(object):
+    """
+    wakes the workers through a capped collection of task events. Tailable cursors work on a standalone
+    mongod (change streams need a replica set), and an awaiting cursor blocks on the server until an
+    event is inserted, so the worker neither sleeps through new tasks nor queries mongo in a busy loop
+    """
+    def __init__(self, db, name='task_events'):
+        self.db = db
+        self.name = name
+        self.events = None
+        self.cursor = None
+        self.last_id = None
+
+    def create(self):
+        """ creates the capped collection on first use, so that nothing talks to mongo before it is needed """
+        if self.events is not None:
+            return
+        if self.name not in self.db.collection_names():
+            try:
+                self.db.create_collection(self.name, capped=True, size=EVENTS_COLLECTION_BYTES)
+                # a tailable cursor over an empty collection dies straight away
+                self.db[self.name].insert({'task_id': None, 'time': time.time()})
+            except pymongo.errors.CollectionInvalid:
+                pass # created by another process in the meantime
+        self.events = self.db[self.name]
+
+    def notify(self, task_id):
+        self.create()
+        self.events.insert({'task_id': task_id, 'time': time.time()})
+
+    def listen(self):
+        """ starts following the events, called before the worker first looks for pending tasks so that none is missed """
+        self.create()
+        if self.last_id is None:
+            last = self.events.find_one(sort=[('$natural', -1)])
+            self.last_id = last['_id'] if last else None
+        query = {'_id': {'$gt': self.last_id}} if self.last_id else {}
+        self.cursor = self.events.find(query, cursor_type=pymongo.CursorType.TAILABLE_AWAIT)
+
+    def wait(self, timeout):
+        """ blocks until a task event arrives (True) or $timeout seconds have passed (False) """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.cursor is None or not self.cursor.alive:
+                self.listen()
+            try:
+                self.last_id = self.cursor.next()['_id']
+                return True
+            except StopIteration:
+                pass # the await timed out on the server, keep waiting
+        return False
+
+def connect():
+    """ opens the mongo connection and the task notifier. Each worker process opens its own, since a MongoClient
+    must not be used across a fork. The client connects lazily, so mongod doesn't need to be up yet """
+    global connection, db, tasks, callbacks, notifier
+    connection = pymongo.MongoClient()
+    db = connection['mydb']
+    tasks = db['tasks']
+    callbacks = db['callbacks']
+    if QUEUE_BACKEND == 'capped':
+        notifier = CappedCollectionNotifier(db)
+    else:
+        notifier = PollingNotifier()
+
+def create_indexes():
+    """ creates the indexes the workers query the queue with, called when a worker starts """
+    tasks.create_index([('status', pymongo.ASCENDING), ('queued_at', pymongo.ASCENDING)])
+    tasks.create_index([('status', pymongo.ASCENDING), ('lease_expires', pymongo.ASCENDING)])
+    callbacks.create_index([('status', pymongo.ASCENDING), ('next_attempt', pymongo.ASCENDING)])
+    callbacks.create_index('task_id')
 
 # a basic URL route to test whether Bottle is responding properly
 @route('/')
 def index():
     return "it works!"
 
+def blob_path(blob):
+    return os.path.join(SPOOL_DIR, blob[:2], blob[2:])
+
+def spool_blob(data):
+    """ writes $data to the spool directory, once, under its sha1 and returns the sha1 """
+    blob = hashlib.sha1(data).hexdigest()
+    path = blob_path(blob)
+    if os.path.exists(path):
+        os.utime(path, None) # keep it from being cleaned up while this task needs it
+        return blob
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass # created by another process in the meantime
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as fh:
+        fh.write(data)
+    os.rename(tmp, path)
+    return blob
+
+def referenced_blobs():
+    """ the blobs of the tasks that are not finished yet, however long they have been waiting """
+    blobs = set()
+    for task in tasks.find({'status': {'$in': ['pending', 'in_progress', 'labeled']}}, {'request.images.blob': 1}):
+        blobs.update(image['blob'] for image in task.get('request', {}).get('images', []) if 'blob' in image)
+    return blobs
+
+def clean_spool(max_age=SPOOL_RETENTION_SECONDS):
+    """ removes the blobs that no task has used for $max_age seconds and that no unfinished task refers to """
+    oldest = time.time() - max_age
+    # read before walking the spool: a blob that a new task uses afterwards has just had its mtime renewed
+    keep = referenced_blobs()
+    removed = 0
+    for directory, _, filenames in os.walk(SPOOL_DIR):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            if os.path.basename(directory) + filename in keep:
+                continue
+            try:
+                if os.path.getmtime(path) < oldest:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass # removed by another worker
+    if removed:
+        print('removed %d old blobs from %s' % (removed, SPOOL_DIR))
+
+def read_image_bytes(image):
+    """ the encoded image (e.g. jpeg) bytes of a payload image, spooled by post_task or inline as image_b64 """
+    if 'blob' in image:
+        with open(blob_path(image['blob']), 'rb') as fh:
+            return fh.read()
+    return base64.b64decode(image['image_b64'])
+
+def parse_task(body):
+    """
+    parses the json payload from the file-like $body, replacing the image_b64 of each image with a reference to
+    its bytes in the spool directory: {"blob": sha1}. With ijson the payload is parsed as a stream, so that only
+    one image is held in memory at a time; without it the whole payload is loaded first
+    """
+    if not ijson:
+        payload = json.load(body)
+        for image in payload.get('images') or []:
+            image['blob'] = spool_blob(base64.b64decode(image.pop('image_b64')))
+        return payload
+    builder = ijson.common.ObjectBuilder()
+    for prefix, event, value in ijson.parse(body):
+        if prefix == 'images.item' and event == 'map_key' and value == 'image_b64':
+            value = 'blob'
+        elif prefix == 'images.item.image_b64' and event == 'string':
+            value = spool_blob(base64.b64decode(value))
+        elif event == 'number' and isinstance(value, decimal.Decimal):
+            value = float(value) # ijson parses non-integers as Decimal, which mongo cannot store
+        builder.event(event, value)
+    return builder.value
+
 @route('/tasks/<secret>',method='POST')
 def post_task(secret):
-    body = request.body.read()    
-    logging.info('payload size %s' % len(body))
+    logging.info('payload size %s' % request.content_length)
     if secret != API_KEY:
         response.status = 400
         return "Invalid API Key"
-    if body:
-        payload = json.loads(body.decode('utf8'))
-        tasks.insert({'request': payload, 'status':'pending'})
+    if request.content_length:
+        payload = parse_task(request.body)
+        task_id = tasks.insert({'request': payload, 'status':'pending', 'queued_at': time.time()})
+        notifier.notify(task_id)
         logging.info('done')
-        images = payload.get('images')
     return 'ok'
 
 @route('/tasks/<secret>',method='GET')
@@ -52,8 +275,18 @@ def get_tasks(secret):
     all_tasks = tasks.find({'status':'pending'})
     return repr([task['request']['user_id']+'/'+task['request']['camera'] for task in all_tasks])
 
+@route('/stats/<secret>',method='GET')
+def get_stats(secret):
+    if secret != API_KEY:
+        response.status = 400
+        return "Invalid API Key"
+    stats = db['stats'].find_one({'_id': 'label_cache'}) or {'hits': 0, 'misses': 0}
+    lookups = stats['hits'] + stats['misses']
+    return {'label_cache': {'hits': stats['hits'], 'misses': stats['misses'],
+                            'hit_rate': float(stats['hits']) / lookups if lookups else 0}}
+
 ###########################################################################
-# This is the function that you modify to perform your particular labeling.
+# These are the functions that you modify to perform your particular labeling.
 # The payload images is a list 
 # [
 #   {
@@ -65,8 +298,11 @@ def get_tasks(secret):
 #   ...
 # ]
 #
-# The custom code in compute_labels should loop and label each one of them and 
-# return a dictionary of the form
+# The worker decodes them into a numpy array of shape (n, height, width, 3)
+# of MODEL_SIZE RGB frames and calls label_batch once per batch of frames.
+# label_batch returns a list with the labels of each frame, which
+# compute_labels maps back to the image timestamps and returns as
+# a dictionary of the form
 #  
 # {
 # "labels: {
@@ -85,51 +321,478 @@ def get_tasks(secret):
 # the top-right corner,
 #
 ###########################################################################
-def compute_labels(images):
-    labels = {}
-    for image in images:
-        image_type = image['type'] # example 'image/jpeg'
-        image_size = image['size'] # (width, height)
-        image_timestamp = image['timestamp'] # in iso format string
-        image_bytes = base64.b64decode(image['image_b64']) # the bytes
-        image = Image.open(StringIO.StringIO(image_bytes)) # a PIL image
-        labels[image_timestamp] = {
+def label_batch(frames):
+    labels = []
+    for frame in frames: # a (height, width, 3) uint8 array
+        labels.append({
             "cat":{"probability":0.93, "polygon":[]}, 
             "dog":{"probability":0.88, "polygon":[]},
-            }
+            })
     return labels
 
-def runtasks():
+def decode_image(image, size=MODEL_SIZE):
+    """ decodes the base64 data of $image into an RGB PIL image of $size. Draft mode lets the jpeg decoder
+    downscale while decoding, which is much faster than decoding at full resolution and resizing """
+    frame = Image.open(StringIO.StringIO(read_image_bytes(image)))
+    frame.draft('RGB', size)
+    return frame.convert('RGB').resize(size, Image.BILINEAR)
+
+def decode_images(images, frames):
+    """ decodes $images into the preallocated uint8 array $frames of shape (>= len(images), height, width, 3) """
+    height, width = frames.shape[1:3]
+    for index, image in enumerate(images):
+        frames[index] = numpy.asarray(decode_image(image, (width, height)))
+    return frames[:len(images)]
+
+# the frames shared with the decoding processes, set in each of them by init_decoder
+SHARED_FRAMES = None
+
+def init_decoder(shared, shape):
+    global SHARED_FRAMES
+    SHARED_FRAMES = numpy.frombuffer(shared, dtype=numpy.uint8).reshape(shape)
+
+def decode_into_shared(args):
+    """ runs in a decoding process: decodes an image into slot $index of frame buffer $buffer, returns the seconds spent """
+    buffer, index, image = args
+    start = time.time()
+    height, width = SHARED_FRAMES.shape[2:4]
+    SHARED_FRAMES[buffer, index] = numpy.asarray(decode_image(image, (width, height)))
+    return time.time() - start
+
+class DecodePool(object):
+    """
+    decodes images in a pool of processes, out of the labeling process and its GIL. The processes write the
+    frames straight into two buffers of BATCH_SIZE frames in shared memory, so only the small base64 payloads
+    and the decoding times are pickled, and one batch can be decoded while the previous one is being labeled
+    """
+    BUFFERS = 2
+
+    def __init__(self, processes, size=MODEL_SIZE, batch_size=BATCH_SIZE):
+        width, height = size
+        shape = (self.BUFFERS, batch_size, height, width, 3)
+        shared = multiprocessing.sharedctypes.RawArray(ctypes.c_uint8, int(numpy.prod(shape)))
+        self.frames = numpy.frombuffer(shared, dtype=numpy.uint8).reshape(shape)
+        self.processes = processes
+        self.pool = multiprocessing.Pool(processes, initializer=init_decoder, initargs=(shared, shape))
+
+    def decode_async(self, images, buffer):
+        """ starts decoding $images into frame buffer $buffer, returns an AsyncResult with the time spent on each """
+        return self.pool.map_async(decode_into_shared, [(buffer, index, image) for (index, image) in enumerate(images)])
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+def image_key(image):
+    """ the label cache key of $image: the model version and the sha1 of the image bytes """
+    blob = image.get('blob') or hashlib.sha1(read_image_bytes(image)).hexdigest()
+    return '%s:%s' % (MODEL_VERSION, blob)
+
+class LabelCache(object):
+    """
+    the labels of the $size most recently used images, by image_key. With $filename the labels are also stored
+    in an sqlite file, which outlives the worker and is shared with the other workers of the host
+    """
+    def __init__(self, size=LABEL_CACHE_SIZE, filename=LABEL_CACHE_FILE):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = self.misses = 0
+        # writes to the file wait for flush(), so that the write lock is only held for one short transaction
+        self.added, self.used = {}, {}
+        self.db = None
+        if filename:
+            self.db = sqlite3.connect(filename, timeout=30)
+            self.db.execute("CREATE TABLE IF NOT EXISTS labels (key TEXT PRIMARY KEY, labels TEXT, used REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS labels_used ON labels (used)")
+            self.db.commit()
+
+    def get(self, key):
+        labels = self.entries.pop(key, None)
+        if labels is None and self.db:
+            row = self.db.execute("SELECT labels FROM labels WHERE key = ?", (key,)).fetchone()
+            if row:
+                labels = json.loads(row[0])
+                self.used[key] = time.time()
+        if labels is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.store(key, labels)
+        return labels
+
+    def put(self, key, labels):
+        self.entries.pop(key, None)
+        self.store(key, labels)
+        if self.db:
+            self.added[key] = (labels, time.time())
+
+    def store(self, key, labels):
+        self.entries[key] = labels
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def flush(self):
+        """ writes the labels added and used since the last flush to the file and drops all but its $size most recently used """
+        if self.db:
+            with self.db:
+                self.db.executemany("UPDATE labels SET used = ? WHERE key = ?",
+                                    [(used, key) for (key, used) in self.used.items()])
+                self.db.executemany("INSERT OR REPLACE INTO labels (key, labels, used) VALUES (?, ?, ?)",
+                                    [(key, json.dumps(labels), used) for (key, (labels, used)) in self.added.items()])
+                self.db.execute("DELETE FROM labels WHERE used < (SELECT MIN(used) FROM "
+                                "(SELECT used FROM labels ORDER BY used DESC LIMIT ?))", (self.size,))
+            self.added, self.used = {}, {}
+
+def store_labels(batch, labels, results, cache):
+    for (index, image), image_labels in zip(batch, labels):
+        results[index][image['timestamp']] = image_labels
+        if cache:
+            cache.put(image_key(image), image_labels)
+
+def compute_labels_batch(events, decoder=None, timings=None, cache=None):
+    """ labels the images of several events together, calling label_batch once per BATCH_SIZE images.
+    $events is a list with the images of each event, returns a list with the labels of each event.
+    decoder - a DecodePool to decode the images in, by default they are decoded in this process
+    timings - a dictionary to which the seconds spent in each stage are added
+    cache   - a LabelCache, the images found in it are neither decoded nor labeled, and an image repeated
+              within $events is only labeled once """
+    images = [(index, image) for (index, event) in enumerate(events) for image in event]
+    results = [{} for _ in events]
+    timings = timings if timings is not None else collections.defaultdict(float)
+    repeated = []
+    if cache:
+        start = time.time()
+        copies = collections.OrderedDict()
+        for index, image in images:
+            copies.setdefault(image_key(image), []).append((index, image))
+        images = []
+        for key, same in copies.items():
+            labels = cache.get(key)
+            if labels is None:
+                images.append(same[0])
+                if len(same) > 1:
+                    repeated.append(same)
+            else:
+                for index, image in same:
+                    results[index][image['timestamp']] = labels
+        timings['cache'] += time.time() - start
+    batches = [images[start:start + BATCH_SIZE] for start in range(0, len(images), BATCH_SIZE)]
+    if decoder:
+        compute_labels_pipelined(batches, results, decoder, timings, cache)
+    else:
+        width, height = MODEL_SIZE
+        frames = numpy.empty((min(BATCH_SIZE, len(images)), height, width, 3), dtype=numpy.uint8)
+        for batch in batches:
+            start = time.time()
+            decoded = decode_images([image for (_, image) in batch], frames)
+            timings['decode'] += time.time() - start
+            start = time.time()
+            store_labels(batch, label_batch(decoded), results, cache)
+            timings['label'] += time.time() - start
+    for same in repeated:
+        index, image = same[0]
+        for copy_index, copy in same[1:]:
+            results[copy_index][copy['timestamp']] = results[index][image['timestamp']]
+    return results
+
+def compute_labels_pipelined(batches, results, decoder, timings, cache=None):
+    """ compute_labels_batch with the decoding in $decoder, decoding each batch while the previous one is labeled """
+    pending = decoder.decode_async([image for (_, image) in batches[0]], 0) if batches else None
+    try:
+        for number, batch in enumerate(batches):
+            start = time.time()
+            seconds = pending.get()
+            timings['decode_wait'] += time.time() - start
+            timings['decode'] += sum(seconds)
+            decoded = decoder.frames[number % DecodePool.BUFFERS, :len(batch)]
+            pending = None
+            if number + 1 < len(batches):
+                pending = decoder.decode_async([image for (_, image) in batches[number + 1]], (number + 1) % DecodePool.BUFFERS)
+            start = time.time()
+            store_labels(batch, label_batch(decoded), results, cache)
+            timings['label'] += time.time() - start
+    finally:
+        # never leave a decode running into a buffer that the next call will reuse
+        if pending:
+            pending.wait()
+    return results
+
+def compute_labels(images):
+    return compute_labels_batch([images])[0]
+
+def claim_task(worker_id):
+    """ atomically takes the oldest pending task for $worker_id, so no two workers ever label the same task """
+    return tasks.find_one_and_update(
+        {'status': 'pending'},
+        {'$set': {'status': 'in_progress', 'worker': worker_id, 'lease_expires': time.time() + LEASE_SECONDS},
+         '$inc': {'attempts': 1}},
+        sort=[('queued_at', pymongo.ASCENDING)],
+        return_document=pymongo.ReturnDocument.AFTER)
+
+def claim_tasks(worker_id, count=TASKS_PER_BATCH):
+    """ claims up to $count tasks, stopping early once they hold a full batch of images """
+    claimed = []
+    images = 0
+    while len(claimed) < count and images < BATCH_SIZE:
+        task = claim_task(worker_id)
+        if not task:
+            break
+        claimed.append(task)
+        images += len(task['request'].get('images') or [])
+    return claimed
+
+def finish_task(task, worker_id, status, **fields):
+    """ records the outcome of $task, unless its lease expired and it was handed to another worker meanwhile """
+    fields['status'] = status
+    result = tasks.update_one({'_id': task['_id'], 'status': 'in_progress', 'worker': worker_id},
+                              {'$set': fields, '$unset': {'lease_expires': ''}})
+    if not result.matched_count:
+        if status == 'labeled' and tasks.find_one({'_id': task['_id'], 'status': 'completed'}, {'_id': 1}):
+            # the callback queued just before was already posted by a sender, so the result was delivered
+            return True
+        print('    lost the lease on task %s, result discarded' % task['_id'])
+    return result.matched_count > 0
+
+def reclaim_expired_leases():
+    """ puts back the tasks of workers that died (their lease expired) for another worker to pick up """
+    expired = {'status': 'in_progress', 'lease_expires': {'$lt': time.time()}}
+    failed = tasks.update_many(dict(expired, attempts={'$gte': MAX_ATTEMPTS}),
+                               {'$set': {'status': 'error', 'traceback': 'lease expired %d times' % MAX_ATTEMPTS}})
+    reclaimed = tasks.update_many(expired, {'$set': {'status': 'pending'}, '$unset': {'worker': '', 'lease_expires': ''}})
+    if failed.modified_count or reclaimed.modified_count:
+        print('reclaimed %d expired tasks, gave up on %d' % (reclaimed.modified_count, failed.modified_count))
+    # callbacks whose sender died while posting them
+    callbacks.update_many({'status': 'sending', 'lease_expires': {'$lt': time.time()}},
+                          {'$set': {'status': 'pending', 'next_attempt': time.time()}, '$unset': {'lease_expires': ''}})
+
+def queue_callback(task, labels):
+    """ stores the labels of $task to be posted to its callback_url by a CallbackSender. It is called before the
+    task is marked labeled, so that a labeled task always has its callback, and only the first call for a task
+    stores one, for when a task is labeled again after its lease expired """
+    callbacks.update_one({'task_id': task['_id']},
+                         {'$setOnInsert': {'callback_url': task['request']['callback_url'],
+                                           'payload': {'status':'success', 'labels':labels}, 'status': 'pending',
+                                           'attempts': 0, 'next_attempt': time.time(), 'queued_at': task.get('queued_at')}},
+                         upsert=True)
+
+class CallbackSender(object):
+    """
+    posts the queued callbacks from a few background threads over a pooled keep-alive session. The callbacks
+    are claimed from mongo like the tasks, so that any worker can send (or retry) the callbacks of another
+    """
+    def __init__(self, threads=CALLBACK_THREADS):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=threads, pool_maxsize=threads)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.condition = threading.Condition()
+        self.threads = [threading.Thread(target=self.run) for _ in range(threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def notify(self):
+        """ wakes up a sender thread for a newly queued callback """
+        with self.condition:
+            self.condition.notify()
+
+    def claim(self):
+        now = time.time()
+        return callbacks.find_one_and_update(
+            {'status': 'pending', 'next_attempt': {'$lte': now}},
+            {'$set': {'status': 'sending', 'lease_expires': now + LEASE_SECONDS}, '$inc': {'attempts': 1}},
+            sort=[('next_attempt', pymongo.ASCENDING)],
+            return_document=pymongo.ReturnDocument.AFTER)
+
+    def run(self):
+        while True:
+            try:
+                callback = self.claim()
+                if callback:
+                    self.send(callback)
+                    continue
+            except:
+                traceback.print_exc()
+            with self.condition:
+                self.condition.wait(POLL_SECONDS)
+
+    def send(self, callback):
+        try:
+            response = self.session.post(callback['callback_url'], json=callback['payload'], timeout=CALLBACK_TIMEOUT_SECONDS)
+            error = None if response.status_code < 400 else 'status %d' % response.status_code
+            retry = response.status_code == 429 or response.status_code >= 500
+        except requests.exceptions.RequestException, e:
+            error, retry = '%s: %s' % (type(e).__name__, e), True
+        if not error:
+            callbacks.delete_one({'_id': callback['_id']})
+            tasks.update_one({'_id': callback['task_id']}, {'$set': {'status': 'completed'}})
+            print('    posted labels, %.3f s after the task was queued' % (time.time() - (callback.get('queued_at') or time.time())))
+        elif retry and callback['attempts'] < CALLBACK_MAX_ATTEMPTS:
+            delay = min(CALLBACK_BACKOFF_SECONDS * 2 ** (callback['attempts'] - 1), CALLBACK_MAX_BACKOFF_SECONDS)
+            delay *= random.uniform(0.5, 1.0)
+            callbacks.update_one({'_id': callback['_id']}, {'$set': {'status': 'pending', 'error': error,
+                                  'next_attempt': time.time() + delay}, '$unset': {'lease_expires': ''}})
+            print('    posting labels failed (%s), retrying in %.0f s' % (error, delay))
+        else:
+            # the labels are kept in the callbacks collection, so they can still be sent by hand
+            callbacks.update_one({'_id': callback['_id']}, {'$set': {'status': 'failed', 'error': error}, '$unset': {'lease_expires': ''}})
+            tasks.update_one({'_id': callback['task_id']}, {'$set': {'status': 'error', 'traceback': 'callback failed: %s' % error}})
+            print('    posting labels failed (%s), giving up after %d attempts' % (error, callback['attempts']))
+
+class Heartbeat(object):
+    """ renews the lease of a list of tasks every HEARTBEAT_SECONDS for as long as the with-block runs """
+    def __init__(self, claimed, worker_id):
+        self.task_ids = [task['_id'] for task in claimed]
+        self.worker_id = worker_id
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def run(self):
+        while not self.stopped.wait(HEARTBEAT_SECONDS):
+            tasks.update_many({'_id': {'$in': self.task_ids}, 'status': 'in_progress', 'worker': self.worker_id},
+                              {'$set': {'lease_expires': time.time() + LEASE_SECONDS}})
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+def record_cache_stats(hits, misses):
+    """ adds to the label cache counters of all the workers, returned by GET /stats/<secret> """
+    if hits or misses:
+        db['stats'].update_one({'_id': 'label_cache'}, {'$inc': {'hits': hits, 'misses': misses}}, upsert=True)
+
+def runtasks(worker_id=None, decode_processes=0):
+    worker_id = worker_id or '%s:%d' % (socket.gethostname(), os.getpid())
+    decoder = DecodePool(decode_processes) if decode_processes else None
+    # started after the decoding processes have been forked
+    sender = CallbackSender()
+    cache = LabelCache()
     t = 0
+    next_reclaim = next_clean = 0
+    create_indexes()
+    notifier.listen()
     while True:
-        task = tasks.find_one({'status':'pending'})
+        if time.time() >= next_reclaim:
+            reclaim_expired_leases()
+            next_reclaim = time.time() + LEASE_SECONDS
+        if time.time() >= next_clean:
+            clean_spool()
+            next_clean = time.time() + SPOOL_RETENTION_SECONDS / 24
+        claimed = claim_tasks(worker_id)
         sys.stdout.flush()
         sys.stderr.flush()
-        if task:
+        if claimed:
+            t = 0
+            print('processing %d tasks' % len(claimed))
+            timings = collections.defaultdict(float)
+            hits, misses = cache.hits, cache.misses
+            with Heartbeat(claimed, worker_id):
+                try:
+                    results = compute_labels_batch([task['request']['images'] for task in claimed], decoder, timings, cache)
+                except:
+                    # label the tasks one at a time below, so that only the task with the bad payload fails
+                    results = [None] * len(claimed)
+                for task, labels in zip(claimed, results):
+                    request = task['request']
+                    try:
+                        if labels is None:
+                            labels = compute_labels(request['images'])
+                        queue_callback(task, labels)
+                        if finish_task(task, worker_id, 'labeled'):
+                            sender.notify()
+                            print('    labeled %.3f s after it was queued' % (time.time() - task.get('queued_at', time.time())))
+                    except:
+                        finish_task(task, worker_id, 'error', traceback=traceback.format_exc())
+            print('    ' + ', '.join('%s %.3f s' % (stage, seconds) for (stage, seconds) in sorted(timings.items())))
+            cache.flush()
+            record_cache_stats(cache.hits - hits, cache.misses - misses)
+            print('    label cache: %d hits, %d misses' % (cache.hits - hits, cache.misses - misses))
+        elif notifier.wait(POLL_SECONDS):
             t = 0
-            print('processing task')
-            request = task['request']
-            try:
-                images = request['images']
-                callback_url = request['callback_url']
-                labels = compute_labels(images)
-                payload = {'status':'success', 'labels':labels}
-                print('    posting payload')
-                requests.post(callback_url, json=payload)
-                print('    done!')
-                task['status'] = 'completed'
-            except:
-                task['status'] = 'error'
-                task['traceback'] = traceback.format_exc()
-            tasks.update({'_id':task['_id']}, task)
         else:
             print('... %i ...' % t)
-            t += 10
-            time.sleep(10)
+            t += POLL_SECONDS
 
-# these two lines are only used for python app.py
+def benchmark(count, decode_processes=0, size=(1280, 720)):
+    """ times labeling $count synthetic jpegs of $size one image at a time against the batched path,
+    and against batches decoded by $decode_processes processes """
+    pixels = numpy.random.randint(0, 256, (size[1] // 8, size[0] // 8, 3)).astype(numpy.uint8)
+    jpeg = StringIO.StringIO()
+    Image.fromarray(pixels).resize(size, Image.BILINEAR).save(jpeg, 'JPEG', quality=85)
+    images = [{'type': 'image/jpeg', 'size': list(size), 'timestamp': '2017-05-05T01:31:%02d.%06d' % (index // 1000000 % 60, index % 1000000),
+               'image_b64': base64.b64encode(jpeg.getvalue())} for index in range(count)]
+    start = time.time()
+    for image in images:
+        label_batch(numpy.asarray(decode_image(image))[numpy.newaxis])
+    single = time.time() - start
+    start = time.time()
+    compute_labels_batch([images])
+    batched = time.time() - start
+    print('%d images of %dx%d labeled at %s' % (count, size[0], size[1], MODEL_SIZE))
+    print('one at a time: %8.1f images/s' % (count / single))
+    print('batched:       %8.1f images/s (batches of %d)' % (count / batched, BATCH_SIZE))
+    if decode_processes:
+        decoder = DecodePool(decode_processes)
+        try:
+            timings = collections.defaultdict(float)
+            start = time.time()
+            compute_labels_batch([images], decoder, timings)
+            pooled = time.time() - start
+        finally:
+            decoder.close()
+        print('decode pool:   %8.1f images/s (%d processes; %s)' % (count / pooled, decode_processes,
+                ', '.join('%s %.3f s' % (stage, seconds) for (stage, seconds) in sorted(timings.items()))))
+
+def run_worker(decode_processes=0):
+    connect()
+    runtasks(decode_processes=decode_processes)
+
+def run_workers(count, decode_processes=0):
+    """ runs $count worker processes, restarting any of them that dies, until interrupted """
+    workers = []
+    try:
+        while True:
+            for worker in workers:
+                if not worker.is_alive():
+                    print('worker %d exited with code %s, restarting it' % (worker.pid, worker.exitcode))
+            workers = [worker for worker in workers if worker.is_alive()]
+            while len(workers) < count:
+                # not a daemon, so that it can start its own pool of decoding processes
+                worker = multiprocessing.Process(target=run_worker, args=(decode_processes,))
+                worker.start()
+                workers.append(worker)
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+
+# these lines are only used for python app.py
 if __name__ == '__main__':
-    runtasks()
-    
+    parser = argparse.ArgumentParser(description='runs the background workers that label the queued hook tasks')
+    parser.add_argument('-p', '--processes', type=int, default=multiprocessing.cpu_count() * WORKERS_PER_CORE,
+                        help='number of worker processes (default = %d per cpu core)' % WORKERS_PER_CORE)
+    parser.add_argument('--benchmark', type=int, metavar='IMAGES', default=0,
+                        help='instead of running the workers, measure the labeling throughput on this many synthetic images')
+    parser.add_argument('-d', '--decode_processes', type=int, default=None,
+                        help='number of processes that decode the images of each worker (default = one per cpu core '
+                        'with a single worker, none with several workers, which then decode their own images)')
+    args = parser.parse_args()
+    if args.decode_processes is None:
+        args.decode_processes = multiprocessing.cpu_count() if args.processes == 1 else 0
+    if args.benchmark:
+        benchmark(args.benchmark, args.decode_processes)
+    elif args.processes > 1:
+        run_workers(args.processes, args.decode_processes)
+    else:
+        run_worker(args.decode_processes)
+else:
+    # imported by Gunicorn, the worker processes above open their own connection
+    connect()
+
 # this is the hook for Gunicorn to run Bottle
 app = default_app()